@@ -44,20 +44,88 @@ sklearn.__version__
 import pandas as pd
 from sklearn.model_selection import train_test_split
 from sklearn.impute import SimpleImputer
-from sklearn.preprocessing import OneHotEncoder
+from sklearn.preprocessing import OneHotEncoder, OrdinalEncoder
 from sklearn.compose import ColumnTransformer
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.pipeline import Pipeline
 from chapter_9_utils import performance_evaluation_report
+from data_utils import load_credit_card_default
 
 from sklearn.tree import DecisionTreeClassifier, export_graphviz
 from sklearn import metrics
+from joblib import Memory
+import numpy as np
+
+
+# In[ ]:
+
+
+def get_preprocessor(num_features, cat_features, cat_list, 
+                     output='dense'):
+    '''
+    Function for creating the preprocessing ColumnTransformer. 
+    The numerical features are imputed with the median, the categorical
+    ones with the most frequent value and then encoded.
+    
+    Parameters
+    ----------
+    num_features : list
+        Names of the numerical features
+    cat_features : list
+        Names of the categorical features
+    cat_list : list
+        List of possible categories for each categorical feature
+    output : str
+        The output of the transformer. One of:
+        * 'dense' - a dense array with one-hot encoded categories,
+        * 'sparse' - a CSR matrix with one-hot encoded categories,
+        * 'codes' - a dense array with integer codes of the categories, 
+          placed after the numerical features. Meant for classifiers 
+          handling categorical features natively (LightGBM, XGBoost).
+          The codes are stacked with the numerical features, so they
+          are stored as float64 (with exact integer values), like the 
+          rest of the array.
+    
+    Returns
+    -------
+    preprocessor : sklearn.compose.ColumnTransformer
+        The (not fitted) preprocessor
+    '''
+    
+    num_pipeline = Pipeline(steps=[
+        ('imputer', SimpleImputer(strategy='median'))
+    ])
+    
+    if output == 'codes':
+        encoder = ('ordinal', OrdinalEncoder(categories=cat_list))
+    elif output in ['dense', 'sparse']:
+        encoder = ('onehot', OneHotEncoder(categories=cat_list, 
+                                           sparse=(output == 'sparse'), 
+                                           handle_unknown='error', 
+                                           drop='first'))
+    else:
+        raise ValueError(f'Unknown output: {output}')
+    
+    cat_pipeline = Pipeline(steps=[
+        ('imputer', SimpleImputer(strategy='most_frequent')),
+        encoder
+    ])
+    
+    # with sparse_threshold=1 the output is always sparse in the 'sparse' mode
+    preprocessor = ColumnTransformer(transformers=[
+        ('numerical', num_pipeline, num_features),
+        ('categorical', cat_pipeline, cat_features)],
+        remainder='drop', 
+        sparse_threshold=1 if output == 'sparse' else 0)
+    
+    return preprocessor
 
 
 # In[4]:
 
 
-df = pd.read_csv('credit_card_default.csv', index_col=0, na_values='')
+# the CSV is parsed once, later runs load the cached Feather file
+df = load_credit_card_default('credit_card_default.csv')
 
 X = df.copy()
 y = X.pop('default_payment_next_month')
@@ -68,49 +136,23 @@ X_train, X_test, y_train, y_test = train_test_split(X, y,
                                                     random_state=42)
 
 num_features = X_train.select_dtypes(include='number').columns.to_list()
-cat_features = X_train.select_dtypes(include='object').columns.to_list()
-
-num_pipeline = Pipeline(steps=[
-    ('imputer', SimpleImputer(strategy='median'))
-])
+cat_features = X_train.select_dtypes(include=['object', 'category']).columns.to_list()
 
 cat_list = [list(X_train[column].dropna().unique()) for column in cat_features]
 
-cat_pipeline = Pipeline(steps=[
-    ('imputer', SimpleImputer(strategy='most_frequent')),
-    ('onehot', OneHotEncoder(categories=cat_list, sparse=False, 
-                             handle_unknown='error', drop='first'))
-])
+preprocessor = get_preprocessor(num_features, cat_features, cat_list)
 
-preprocessor = ColumnTransformer(transformers=[
-    ('numerical', num_pipeline, num_features),
-    ('categorical', cat_pipeline, cat_features)],
-    remainder='drop')
+# the fitted preprocessor is cached on disk, keyed by its parameters and 
+# the input data, so all the pipelines and CV folds sharing it fit it only 
+# once per distinct training set
+memory = Memory(location='preprocessor_cache', verbose=0)
 
+# the baseline is trained together with the other pipelines
 tree_pipeline = Pipeline(steps=[('preprocessor', preprocessor),
-                                ('classifier', DecisionTreeClassifier(random_state=42))])
-
-tree_pipeline.fit(X_train, y_train)
+                                ('classifier', DecisionTreeClassifier(random_state=42))],
+                         memory=memory)
 
 LABELS = ['No Default', 'Default']
-tree_perf = performance_evaluation_report(tree_pipeline, X_test, 
-                                          y_test, labels=LABELS, 
-                                          show_plot=True, 
-                                          show_pr_curve=True)
-
-
-# In[5]:
-
-
-tree_perf
-
-
-# In[6]:
-
-
-# investigate the depth of the tree
-tree_classifier = tree_pipeline.named_steps['classifier']
-tree_classifier.tree_.max_depth
 
 
 # ### How to do it...
@@ -134,16 +176,7 @@ from lightgbm import LGBMClassifier
 rf = RandomForestClassifier(random_state=42)
 rf_pipeline = Pipeline(steps=[('preprocessor', preprocessor),
                               ('classifier', rf)
-                             ])
-
-rf_pipeline.fit(X_train, y_train)
-rf_perf = performance_evaluation_report(rf_pipeline, X_test, 
-                                        y_test, labels=LABELS, 
-                                        show_plot=True,
-                                        show_pr_curve=True)
-
-# plt.savefig('images/ch9_im1.png', dpi=300)
-plt.show()
+                             ], memory=memory)
 
 
 # 3. Create a Gradient Boosting Trees Pipeline:
@@ -154,16 +187,7 @@ plt.show()
 gbt =  GradientBoostingClassifier(random_state=42)
 gbt_pipeline = Pipeline(steps=[('preprocessor', preprocessor),
                                ('classifier', gbt)
-                              ])
-
-gbt_pipeline.fit(X_train, y_train)
-gbt_perf = performance_evaluation_report(gbt_pipeline, X_test, 
-                                         y_test, labels=LABELS, 
-                                         show_plot=True,
-                                         show_pr_curve=True)
-
-# plt.savefig('images/ch9_im2.png', dpi=300)
-plt.show()
+                              ], memory=memory)
 
 
 # 4. Create a xgBoost Pipeline:
@@ -174,16 +198,7 @@ plt.show()
 xgb = XGBClassifier(random_state=42)
 xgb_pipeline = Pipeline(steps=[('preprocessor', preprocessor),
                                ('classifier', xgb)
-                              ])
-
-xgb_pipeline.fit(X_train, y_train)
-xgb_perf = performance_evaluation_report(xgb_pipeline, X_test, 
-                                         y_test, labels=LABELS, 
-                                         show_plot=True,
-                                         show_pr_curve=True)
-
-# plt.savefig('images/ch9_im3.png', dpi=300)
-plt.show()
+                              ], memory=memory)
 
 
 # 5. Create a LightGBM classifier Pipeline:
@@ -194,20 +209,361 @@ plt.show()
 lgbm = LGBMClassifier(random_state=42)
 lgbm_pipeline = Pipeline(steps=[('preprocessor', preprocessor),
                                 ('classifier', lgbm)
-                               ])
+                               ], memory=memory)
 
-lgbm_pipeline.fit(X_train, y_train)
-lgbm_perf = performance_evaluation_report(lgbm_pipeline, X_test, 
-                                          y_test, labels=LABELS, 
-                                          show_plot=True,
-                                          show_pr_curve=True)
 
-# plt.savefig('images/ch9_im4.png', dpi=300)
-plt.show()
+# 6. Train all the pipelines concurrently. First, define the functions for training the models in separate processes:
+
+# In[ ]:
+
+
+from joblib import Parallel, delayed, cpu_count
+
+
+def get_core_budgets(pipelines, n_cores=None):
+    '''
+    Function for splitting the available cores between the pipelines.
+    Classifiers without the `n_jobs` parameter get a single core, 
+    the remaining cores are split evenly among the other ones.
+    
+    Parameters
+    ----------
+    pipelines : dict
+        Dictionary with the names and the pipelines
+    n_cores : int
+        Number of cores to split, by default all the available ones
+    
+    Returns
+    -------
+    core_budgets : dict
+        Dictionary with the names of the pipelines and their number of cores
+    '''
+    
+    if n_cores is None:
+        n_cores = cpu_count()
+    
+    multi_core = [name for name, pipeline in pipelines.items() 
+                  if 'classifier__n_jobs' in pipeline.get_params()]
+    n_remaining = max(n_cores - (len(pipelines) - len(multi_core)), 
+                      len(multi_core))
+    
+    core_budgets = {name: 1 for name in pipelines}
+    for ind, name in enumerate(multi_core):
+        core_budgets[name] = (n_remaining // len(multi_core) + 
+                              (ind < n_remaining % len(multi_core)))
+    
+    return core_budgets
+
+
+def fit_and_evaluate(pipeline, X_train, y_train, X_test, y_test, 
+                     n_jobs=1, labels=None):
+    '''
+    Function for fitting a pipeline using the given number of cores 
+    and evaluating its performance on the test set.
+    
+    Parameters
+    ----------
+    pipeline : sklearn.pipeline.Pipeline
+        The pipeline to be fitted
+    X_train, y_train : pd.DataFrame, pd.Series
+        The training data
+    X_test, y_test : pd.DataFrame, pd.Series
+        The test data
+    n_jobs : int
+        Number of cores the classifier can use
+    labels : list
+        Labels of the classes
+    
+    Returns
+    -------
+    pipeline : sklearn.pipeline.Pipeline
+        The fitted pipeline
+    performance : dict
+        The performance metrics of the pipeline
+    '''
+    
+    if 'classifier__n_jobs' in pipeline.get_params():
+        pipeline.set_params(classifier__n_jobs=n_jobs)
+    
+    pipeline.fit(X_train, y_train)
+    performance = performance_evaluation_report(pipeline, X_test, y_test, 
+                                                labels=labels, 
+                                                show_plot=False)
+    
+    return pipeline, performance
+
+
+def train_pipelines(pipelines, X_train, y_train, X_test, y_test, 
+                    core_budgets=None, labels=None):
+    '''
+    Function for training the pipelines concurrently on a process pool
+    and comparing their performance. Each pipeline uses only its own 
+    budget of cores, so the processes do not oversubscribe the machine.
+    
+    Parameters
+    ----------
+    pipelines : dict
+        Dictionary with the names and the pipelines
+    X_train, y_train : pd.DataFrame, pd.Series
+        The training data
+    X_test, y_test : pd.DataFrame, pd.Series
+        The test data
+    core_budgets : dict
+        Number of cores per pipeline, by default `get_core_budgets`
+    labels : list
+        Labels of the classes
+    
+    Returns
+    -------
+    results_comparison : pd.DataFrame
+        DataFrame with the performance metrics of each pipeline
+    fitted_pipelines : dict
+        Dictionary with the names and the fitted pipelines
+    '''
+    
+    if core_budgets is None:
+        core_budgets = get_core_budgets(pipelines)
+    
+    results = Parallel(n_jobs=len(pipelines), backend='loky')(
+        delayed(fit_and_evaluate)(pipeline, X_train, y_train, 
+                                  X_test, y_test, 
+                                  n_jobs=core_budgets[name], 
+                                  labels=labels)
+        for name, pipeline in pipelines.items()
+    )
+    
+    fitted_pipelines = {name: result[0] 
+                        for name, result in zip(pipelines, results)}
+    results_comparison = pd.DataFrame(
+        {name: result[1] for name, result in zip(pipelines, results)}
+    ).T
+    
+    return results_comparison, fitted_pipelines
+
+
+# Then, train the registered pipelines:
+
+# In[ ]:
+
+
+pipelines = {'decision_tree_baseline': tree_pipeline,
+             'random_forest': rf_pipeline,
+             'gradient_boosted_trees': gbt_pipeline,
+             'xgboost': xgb_pipeline,
+             'light_gbm': lgbm_pipeline}
+
+baseline_results, fitted_pipelines = train_pipelines(pipelines, 
+                                                     X_train, y_train, 
+                                                     X_test, y_test, 
+                                                     labels=LABELS)
+baseline_results
+
+
+# 7. Plot the performance of the fitted pipelines (the models are not fitted again, only their predictions on the test set are evaluated):
+
+# In[ ]:
+
+
+for name, fitted_pipeline in fitted_pipelines.items():
+    performance_evaluation_report(fitted_pipeline, X_test, 
+                                  y_test, labels=LABELS, 
+                                  show_plot=True,
+                                  show_pr_curve=True)
+    plt.suptitle(name)
+    plt.show()
+
+
+# In[ ]:
+
+
+# investigate the depth of the baseline tree
+tree_classifier = fitted_pipelines['decision_tree_baseline'].named_steps['classifier']
+tree_classifier.tree_.max_depth
 
 
 # ### There's more
 
+# The one-hot encoded output of the preprocessor is dense, so all the dummy variables are materialized for every fit and transform. All the considered classifiers also accept sparse matrices:
+
+# In[ ]:
+
+
+sparse_preprocessor = get_preprocessor(num_features, cat_features, 
+                                       cat_list, output='sparse')
+lgbm_sparse_pipeline = Pipeline(steps=[('preprocessor', sparse_preprocessor),
+                                       ('classifier', LGBMClassifier(random_state=42))
+                                      ], memory=memory)
+
+lgbm_sparse_pipeline.fit(X_train, y_train)
+lgbm_sparse_perf = performance_evaluation_report(lgbm_sparse_pipeline, X_test, 
+                                                 y_test, labels=LABELS, 
+                                                 show_plot=True,
+                                                 show_pr_curve=True)
+
+
+# LightGBM and XGBoost can also handle categorical features natively, without one-hot encoding. In that case, the preprocessor passes the integer codes of the categories and we indicate which columns contain them:
+
+# In[ ]:
+
+
+codes_preprocessor = get_preprocessor(num_features, cat_features, 
+                                      cat_list, output='codes')
+# the codes are placed after the numerical features
+cat_indices = list(range(len(num_features), 
+                         len(num_features) + len(cat_features)))
+
+lgbm_cat_pipeline = Pipeline(steps=[('preprocessor', codes_preprocessor),
+                                    ('classifier', LGBMClassifier(random_state=42))
+                                   ], memory=memory)
+
+lgbm_cat_pipeline.fit(X_train, y_train, 
+                      classifier__categorical_feature=cat_indices)
+lgbm_cat_perf = performance_evaluation_report(lgbm_cat_pipeline, X_test, 
+                                              y_test, labels=LABELS, 
+                                              show_plot=True,
+                                              show_pr_curve=True)
+
+
+# In[ ]:
+
+
+feature_types = ['q'] * len(num_features) + ['c'] * len(cat_features)
+xgb_cat = XGBClassifier(random_state=42, tree_method='hist', 
+                        enable_categorical=True, 
+                        feature_types=feature_types)
+
+xgb_cat_pipeline = Pipeline(steps=[('preprocessor', codes_preprocessor),
+                                   ('classifier', xgb_cat)
+                                  ], memory=memory)
+
+xgb_cat_pipeline.fit(X_train, y_train)
+xgb_cat_perf = performance_evaluation_report(xgb_cat_pipeline, X_test, 
+                                             y_test, labels=LABELS, 
+                                             show_plot=True,
+                                             show_pr_curve=True)
+
+
+# When scoring a single account at a time (for example, in a real-time credit decision API), most of the time of `predict_proba` is spent on validating the DataFrame and dispatching the columns to the transformers. `CompiledPipeline` extracts the fitted medians, category tables and the model into flat lists and scores a dictionary (or a NumPy row) directly:
+
+# In[ ]:
+
+
+from scoring_utils import CompiledPipeline
+
+compiled_tree = CompiledPipeline(fitted_pipelines['decision_tree_baseline'])
+record = X_test.iloc[0].to_dict()
+
+print(compiled_tree.predict_proba(record))
+print(fitted_pipelines['decision_tree_baseline'].predict_proba(X_test.iloc[[0]])[0])
+
+
+# In[ ]:
+
+
+get_ipython().run_line_magic('timeit', "fitted_pipelines['decision_tree_baseline'].predict_proba(X_test.iloc[[0]])")
+get_ipython().run_line_magic('timeit', 'compiled_tree.predict_proba(record)')
+
+
+# The prediction of the Random Forest walks the trees one by one, calling each tree (and validating the input) separately. `compile_pipeline` flattens the fitted forest into contiguous node arrays, traversed by a single function compiled with `numba` (and in parallel threads over blocks of rows), while returning the same probabilities. With `n_jobs` > 1, the Random Forest adds up the probabilities of the trees in the order in which the threads finish, so its predictions can differ in the last bits between calls. That is why we compare against a copy of the fitted pipeline predicting in a single thread, which keeps the order of the trees:
+
+# In[ ]:
+
+
+from copy import deepcopy
+from scoring_utils import compile_pipeline
+
+rf_compiled_pipeline = compile_pipeline(fitted_pipelines['random_forest'])
+rf_single_thread = deepcopy(fitted_pipelines['random_forest'])
+rf_single_thread.set_params(classifier__n_jobs=1)
+
+np.array_equal(rf_compiled_pipeline.predict_proba(X_test), 
+               rf_single_thread.predict_proba(X_test))
+
+
+# To compare the prediction times fairly, both the Random Forest and the compiled forest use the same number of threads. We time a single account, a small batch and the entire test set:
+
+# In[ ]:
+
+
+import time
+
+def time_predictions(model, X, n_repeats=5):
+    '''
+    Returns the best time of `n_repeats` calls of `model.predict_proba`.
+    '''
+    model.predict_proba(X)
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        model.predict_proba(X)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+rf_timings = {}
+for n_jobs in [1, -1]:
+    rf_n_jobs = deepcopy(fitted_pipelines['random_forest'])
+    rf_n_jobs.set_params(classifier__n_jobs=n_jobs)
+    rf_compiled_n_jobs = compile_pipeline(rf_n_jobs, n_jobs=n_jobs)
+    for n_rows in [1, 16, len(X_test)]:
+        rf_timings[(n_jobs, n_rows)] = {
+            'random_forest': time_predictions(rf_n_jobs, X_test.iloc[:n_rows]), 
+            'compiled_forest': time_predictions(rf_compiled_n_jobs, 
+                                                X_test.iloc[:n_rows])
+        }
+
+rf_timings = pd.DataFrame(rf_timings).T.rename_axis(['n_jobs', 'n_rows'])
+rf_timings['speedup'] = rf_timings.random_forest / rf_timings.compiled_forest
+rf_timings
+
+
+# When many accounts are scored concurrently behind an API, it is more efficient to coalesce the requests into micro-batches and score them with a single vectorized call. We save the fitted pipeline and serve it with the micro-batching server from `scoring_server.py`, which also exposes the latency and throughput metrics under `/metrics`:
+# 
+# ```
+# python scoring_server.py serve light_gbm_pipeline.joblib --port 8000 --batch-window-ms 5
+# python scoring_server.py load-test --port 8000 --n-requests 10000 --concurrency 64
+# ```
+
+# In[ ]:
+
+
+from scoring_utils import save_pipeline
+
+save_pipeline(fitted_pipelines['light_gbm'], 'light_gbm_pipeline.joblib')
+
+
+# The same saved pipeline can be used for re-scoring a large file of accounts. `batch_score.py` reads the file (CSV or Parquet) in chunks, scores them in several worker processes and writes the probabilities incrementally:
+# 
+# ```
+# python batch_score.py credit_card_default.csv light_gbm_pipeline.joblib scores.csv --index-col 0 --chunksize 100000 --n-jobs 4
+# ```
+
+# `save_pipeline` stores the NumPy arrays of the pipeline in a memory-mappable layout and `load_pipeline` memory-maps them, so the scoring processes loading the same file share a single copy of the arrays. The trees of scikit-learn's Random Forest (and the boosters of LightGBM) are not NumPy arrays, so every process would load its own copy of them. Compiling the forest first stores its nodes in NumPy arrays, which are then shared. Below, the workers of a process pool load the compiled pipeline and score a part of the test set each. The compiled forest uses a single thread, as the parallelism comes from the processes:
+
+# In[ ]:
+
+
+from scoring_utils import load_pipeline
+
+save_pipeline(compile_pipeline(fitted_pipelines['random_forest'], n_jobs=1), 
+              'rf_compiled_pipeline.joblib')
+
+def score_chunk(path, X_chunk):
+    # every worker memory-maps the node arrays from the same file
+    pipeline = load_pipeline(path)
+    return pipeline.predict_proba(X_chunk)
+
+rf_chunk_scores = Parallel(n_jobs=4)(
+    delayed(score_chunk)('rf_compiled_pipeline.joblib', X_chunk) 
+    for X_chunk in np.array_split(X_test, 4)
+)
+
+rf_loaded_forest = load_pipeline('rf_compiled_pipeline.joblib').steps[-1][1]
+print(type(rf_loaded_forest.threshold))
+np.array_equal(np.vstack(rf_chunk_scores), 
+               rf_single_thread.predict_proba(X_test))
+
+
+
 # Below we go over the most important hyperparameters of the considered models and show a possible way of tuning them using Randomized Search. With more complex models, the training time is significantly longer than with the basic Decision Tree, so we need to find a balance between the time we want to spend on tuning the hyperparameters and the expected results. Also, bear in mind that changing the values of some parameters (such as learning rate or the number of estimators) can itself influence the training time of the models.
 # 
 # To have the results in a reasonable amount of time, we used the Randomized Search with 100 different sets of hyperparameters for each model (the number of actually fitted models is higher due to cross-validation). Just as in the recipe *Grid Search and Cross-Validation*, we used recall as the criterion for selecting the best model. Additionally, we used the scikit-learn compatible APIs of XGBoost and LightGBM to make the process as easy to follow as possible. For a complete list of hyperparameters and their meaning, please refer to corresponding documentations.
@@ -394,22 +750,254 @@ lgbm_rs_perf = performance_evaluation_report(lgbm_rs, X_test,
                                              show_pr_curve=True)
 
 
+# **Successive halving**
+
+# Each of the randomized searches above fits all the `N_SEARCHES` candidates on every fold, using the full training set and the sampled number of estimators. With successive halving (requires `scikit-learn` 0.24 or above), all the candidates are first evaluated using a small budget of resources. Only the best `1 / factor` of them advance to the next iteration, in which they get `factor` times more resources. As the resource, we can use the number of estimators (it is then removed from the grid and its range determines the budget) or the number of observations in the training set (`'n_samples'`).
+
+# In[ ]:
+
+
+from sklearn.experimental import enable_halving_search_cv
+from sklearn.model_selection import HalvingRandomSearchCV
+
+
+def get_halving_search(pipeline, param_grid, 
+                       resource='classifier__n_estimators', factor=3):
+    '''
+    Function for creating the successive halving counterpart of 
+    the randomized search used above.
+    
+    Parameters
+    ----------
+    pipeline : sklearn.pipeline.Pipeline
+        The pipeline to be tuned
+    param_grid : dict
+        The grid of hyperparameters
+    resource : str
+        The resource allocated to the candidates. Either a hyperparameter
+        of the pipeline (then its values in the grid determine the minimum 
+        and maximum budget) or 'n_samples'.
+    factor : int
+        The proportion of candidates selected for the next iteration
+    
+    Returns
+    -------
+    halving_search : sklearn.model_selection.HalvingRandomSearchCV
+        The (not fitted) search object
+    '''
+    
+    param_grid = param_grid.copy()
+    
+    if resource in param_grid:
+        resource_values = param_grid.pop(resource)
+        min_resources = int(min(resource_values))
+        max_resources = int(max(resource_values))
+    else:
+        min_resources, max_resources = 'exhaust', 'auto'
+    
+    halving_search = HalvingRandomSearchCV(pipeline, param_grid, 
+                                           n_candidates=N_SEARCHES, 
+                                           resource=resource, 
+                                           factor=factor, 
+                                           min_resources=min_resources,
+                                           max_resources=max_resources,
+                                           scoring='recall', cv=k_fold, 
+                                           n_jobs=-1, verbose=1, 
+                                           random_state=42)
+    
+    return halving_search
+
+
+# In[ ]:
+
+
+rf_hs = get_halving_search(rf_pipeline, rf_param_grid)
+rf_hs.fit(X_train, y_train)
+
+print(f'Best parameters: {rf_hs.best_params_}') 
+print(f'Recall (Training set): {rf_hs.best_score_:.4f}') 
+print(f'Recall (Test set): {metrics.recall_score(y_test, rf_hs.predict(X_test)):.4f}')
+
+rf_hs_perf = performance_evaluation_report(rf_hs, X_test, 
+                                           y_test, labels=LABELS, 
+                                           show_plot=True,
+                                           show_pr_curve=True)
+
+
+# In[ ]:
+
+
+gbt_hs = get_halving_search(gbt_pipeline, gbt_param_grid)
+gbt_hs.fit(X_train, y_train)
+
+print(f'Best parameters: {gbt_hs.best_params_}') 
+print(f'Recall (Training set): {gbt_hs.best_score_:.4f}') 
+print(f'Recall (Test set): {metrics.recall_score(y_test, gbt_hs.predict(X_test)):.4f}')
+
+gbt_hs_perf = performance_evaluation_report(gbt_hs, X_test, 
+                                            y_test, labels=LABELS, 
+                                            show_plot=True,
+                                            show_pr_curve=True)
+
+
+# In[ ]:
+
+
+xgb_hs = get_halving_search(xgb_pipeline, xgb_param_grid)
+xgb_hs.fit(X_train, y_train)
+
+print(f'Best parameters: {xgb_hs.best_params_}') 
+print(f'Recall (Training set): {xgb_hs.best_score_:.4f}') 
+print(f'Recall (Test set): {metrics.recall_score(y_test, xgb_hs.predict(X_test)):.4f}')
+
+xgb_hs_perf = performance_evaluation_report(xgb_hs, X_test, 
+                                            y_test, labels=LABELS, 
+                                            show_plot=True,
+                                            show_pr_curve=True)
+
+
+# In[ ]:
+
+
+lgbm_hs = get_halving_search(lgbm_pipeline, lgbm_param_grid)
+lgbm_hs.fit(X_train, y_train)
+
+print(f'Best parameters: {lgbm_hs.best_params_}') 
+print(f'Recall (Training set): {lgbm_hs.best_score_:.4f}') 
+print(f'Recall (Test set): {metrics.recall_score(y_test, lgbm_hs.predict(X_test)):.4f}')
+
+lgbm_hs_perf = performance_evaluation_report(lgbm_hs, X_test, 
+                                             y_test, labels=LABELS, 
+                                             show_plot=True,
+                                             show_pr_curve=True)
+
+
+# **Warm-started sweeps of the number of estimators**
+# 
+# In the randomized searches, the number of estimators is sampled together with the other hyperparameters, so configurations differing only in it are fitted from scratch. However, a random forest with 300 trees consists of the first 300 trees of a forest with 1000 trees (grown with the same random state) and a boosted ensemble with 300 rounds is the first 300 rounds of one with 1000 rounds. That is why `EstimatorSweepSearchCV` fits each sampled configuration once (per fold) with the largest number of estimators from the grid and scores all the smaller ones from that fit: by averaging the probabilities of the first trees of the forest, using `staged_predict_proba` of the gradient boosted trees and the `iteration_range`/`num_iteration` arguments of XGBoost/LightGBM. The scores are identical to fitting the smaller ensembles separately, but every configuration is evaluated for all 10 numbers of estimators. To keep the budget comparable with the randomized search (the average sampled number of estimators is about half of the largest one), we sample half as many configurations.
+
+# In[ ]:
+
+
+from tuning_utils import EstimatorSweepSearchCV
+
+
+def get_estimator_sweep(pipeline, param_grid, 
+                        param_name='classifier__n_estimators'):
+    '''
+    Function for creating the warm-started counterpart of 
+    the randomized search used above.
+    
+    Parameters
+    ----------
+    pipeline : sklearn.pipeline.Pipeline
+        The pipeline to be tuned
+    param_grid : dict
+        The grid of hyperparameters
+    param_name : str
+        The hyperparameter with the number of estimators
+    
+    Returns
+    -------
+    sweep_search : EstimatorSweepSearchCV
+        The (not fitted) search object
+    '''
+    
+    sweep_search = EstimatorSweepSearchCV(pipeline, param_grid, 
+                                          n_iter=max(1, N_SEARCHES // 2), 
+                                          scoring='recall', cv=k_fold, 
+                                          n_jobs=-1, verbose=1, 
+                                          random_state=42, 
+                                          param_name=param_name)
+    
+    return sweep_search
+
+
+# In[ ]:
+
+
+rf_ws = get_estimator_sweep(rf_pipeline, rf_param_grid)
+rf_ws.fit(X_train, y_train)
+
+print(f'Best parameters: {rf_ws.best_params_}') 
+print(f'Recall (Training set): {rf_ws.best_score_:.4f}') 
+print(f'Recall (Test set): {metrics.recall_score(y_test, rf_ws.predict(X_test)):.4f}')
+
+rf_ws_perf = performance_evaluation_report(rf_ws, X_test, 
+                                           y_test, labels=LABELS, 
+                                           show_plot=True,
+                                           show_pr_curve=True)
+
+
+# In[ ]:
+
+
+gbt_ws = get_estimator_sweep(gbt_pipeline, gbt_param_grid)
+gbt_ws.fit(X_train, y_train)
+
+print(f'Best parameters: {gbt_ws.best_params_}') 
+print(f'Recall (Training set): {gbt_ws.best_score_:.4f}') 
+print(f'Recall (Test set): {metrics.recall_score(y_test, gbt_ws.predict(X_test)):.4f}')
+
+gbt_ws_perf = performance_evaluation_report(gbt_ws, X_test, 
+                                            y_test, labels=LABELS, 
+                                            show_plot=True,
+                                            show_pr_curve=True)
+
+
+# In[ ]:
+
+
+xgb_ws = get_estimator_sweep(xgb_pipeline, xgb_param_grid)
+xgb_ws.fit(X_train, y_train)
+
+print(f'Best parameters: {xgb_ws.best_params_}') 
+print(f'Recall (Training set): {xgb_ws.best_score_:.4f}') 
+print(f'Recall (Test set): {metrics.recall_score(y_test, xgb_ws.predict(X_test)):.4f}')
+
+xgb_ws_perf = performance_evaluation_report(xgb_ws, X_test, 
+                                            y_test, labels=LABELS, 
+                                            show_plot=True,
+                                            show_pr_curve=True)
+
+
+# In[ ]:
+
+
+lgbm_ws = get_estimator_sweep(lgbm_pipeline, lgbm_param_grid)
+lgbm_ws.fit(X_train, y_train)
+
+print(f'Best parameters: {lgbm_ws.best_params_}') 
+print(f'Recall (Training set): {lgbm_ws.best_score_:.4f}') 
+print(f'Recall (Test set): {metrics.recall_score(y_test, lgbm_ws.predict(X_test)):.4f}')
+
+lgbm_ws_perf = performance_evaluation_report(lgbm_ws, X_test, 
+                                             y_test, labels=LABELS, 
+                                             show_plot=True,
+                                             show_pr_curve=True)
+
+
 # Below we present a summary of all the classifiers we have considered in the last 3 recipes.
 
 # In[ ]:
 
 
-results_dict = {'decision_tree_baseline': tree_perf,
-                'random_forest': rf_perf,
-                'random_forest_rs': rf_rs_perf,
-                'gradient_boosted_trees': gbt_perf,
+# the results of the default pipelines come from `train_pipelines`
+results_dict = {'random_forest_rs': rf_rs_perf,
                 'gradient_boosted_trees_rs': gbt_rs_perf,
-                'xgboost': xgb_perf,
                 'xgboost_rs': xgb_rs_perf,
-                'light_gbm': lgbm_perf,
-                'light_gbm_rs': lgbm_rs_perf}
-
-results_comparison = pd.DataFrame(results_dict).T
+                'light_gbm_rs': lgbm_rs_perf,
+                'random_forest_hs': rf_hs_perf,
+                'gradient_boosted_trees_hs': gbt_hs_perf,
+                'xgboost_hs': xgb_hs_perf,
+                'light_gbm_hs': lgbm_hs_perf,
+                'random_forest_ws': rf_ws_perf,
+                'gradient_boosted_trees_ws': gbt_ws_perf,
+                'xgboost_ws': xgb_ws_perf,
+                'light_gbm_ws': lgbm_ws_perf}
+
+results_comparison = pd.concat([baseline_results, 
+                                pd.DataFrame(results_dict).T])
 results_comparison
 
 
@@ -443,9 +1031,10 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.naive_bayes import GaussianNB
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.tree import DecisionTreeClassifier
-from sklearn.ensemble import StackingClassifier
 from sklearn.linear_model import LogisticRegression
 
+from stacking_utils import CachedStackingClassifier, fit_estimator
+
 
 # 2. Load and preprocess data:
 
@@ -456,6 +1045,9 @@ RANDOM_STATE = 42
 
 k_fold = StratifiedKFold(5, shuffle=True, random_state=42)
 
+# fitted base models and their out-of-fold predictions are cached on disk
+STACKING_CACHE = 'stacking_cache'
+
 df = pd.read_csv('credit_card_fraud.csv')
 
 X = df.copy()
@@ -491,22 +1083,25 @@ for model_tuple in clf_list:
     model = model_tuple[1]
     if 'random_state' in model.get_params().keys():
         model.set_params(random_state=RANDOM_STATE)
-    model.fit(X_train, y_train)
+    model = fit_estimator(model, X_train, y_train, memory=STACKING_CACHE)
     y_pred = model.predict(X_test)
     recall = metrics.recall_score(y_pred, y_test)
     print(f"{model_tuple[0]}'s recall score: {recall:.4f}")
 
 
 # 5. Define and fit the stacking classifier:
+# 
+# `CachedStackingClassifier` is equivalent to `StackingClassifier`, but it caches the base models fitted to the entire training set (so the ones fitted in the previous step are not fitted again) and their out-of-fold predictions, per fold. The cache is keyed by the hyperparameters of the models, the data and the folds.
 
 # In[11]:
 
 
 lr = LogisticRegression()
-stack_clf = StackingClassifier(clf_list, 
-                               final_estimator=lr,
-                               cv=k_fold,
-                               n_jobs=-1)
+stack_clf = CachedStackingClassifier(clf_list, 
+                                     final_estimator=lr,
+                                     cv=k_fold,
+                                     n_jobs=-1,
+                                     memory=STACKING_CACHE)
 stack_clf.fit(X_train, y_train)
 
 
@@ -515,11 +1110,120 @@ stack_clf.fit(X_train, y_train)
 # In[12]:
 
 
-y_pred = stacking_clf.predict(X_test)
+y_pred = stack_clf.predict(X_test)
 recall = metrics.recall_score(y_pred, y_test)
 print(f"The stacked ensemble's recall score: {recall:.4f}")
 
 
+# ### There's more
+# 
+# Thanks to the cache, changing the meta-learner or adding another base model to the ensemble only fits the new models, while the out-of-fold predictions of the other ones are loaded from the cache:
+
+# In[ ]:
+
+
+from sklearn.ensemble import RandomForestClassifier
+
+stack_clf.set_params(final_estimator=RandomForestClassifier(random_state=RANDOM_STATE))
+stack_clf.fit(X_train, y_train)
+
+y_pred = stack_clf.predict(X_test)
+recall = metrics.recall_score(y_pred, y_test)
+print(f"Random forest as the meta-learner - recall score: {recall:.4f}")
+
+stack_clf.set_params(final_estimator=lr,
+                     estimators=clf_list + [('log_reg_l1', 
+                                             LogisticRegression(penalty='l1', 
+                                                                solver='liblinear'))])
+stack_clf.fit(X_train, y_train)
+
+y_pred = stack_clf.predict(X_test)
+recall = metrics.recall_score(y_pred, y_test)
+print(f"Additional base model - recall score: {recall:.4f}")
+
+
+# The predictions of the k-nearest neighbours model are the slowest part of the ensemble's inference, as the exact search computes the distances to all the observations in the training set. `ApproximateKNeighborsClassifier` finds the neighbours using a forest of random projection trees, which only compares the query with the observations sharing a leaf with it in one of the trees. More trees (`n_trees`) and larger leaves (`leaf_size`) find more of the true neighbours, at the cost of slower predictions. Below we compare a few settings with the exact search:
+
+# In[ ]:
+
+
+import time
+import numpy as np
+from neighbors_utils import ApproximateKNeighborsClassifier
+
+knn = KNeighborsClassifier().fit(X_train, y_train)
+start = time.perf_counter()
+exact_neighbors = knn.kneighbors(X_test, return_distance=False)
+exact_pred = knn.predict(X_test)
+exact_time = time.perf_counter() - start
+
+knn_results = {'exact': {'predict_time': exact_time,
+                         'neighbor_recall': 1.0,
+                         'agreement': 1.0,
+                         'recall': metrics.recall_score(y_test, exact_pred)}}
+
+for n_trees, leaf_size in [(5, 30), (10, 30), (20, 50)]:
+    approx_knn = ApproximateKNeighborsClassifier(n_trees=n_trees, 
+                                                 leaf_size=leaf_size, 
+                                                 random_state=RANDOM_STATE)
+    approx_knn.fit(X_train, y_train)
+    start = time.perf_counter()
+    approx_neighbors = approx_knn.kneighbors(X_test, return_distance=False)
+    approx_pred = approx_knn.predict(X_test)
+    approx_time = time.perf_counter() - start
+    
+    # share of the true neighbours found by the index
+    neighbor_recall = np.mean([len(np.intersect1d(exact, approx)) / len(exact) 
+                               for exact, approx 
+                               in zip(exact_neighbors, approx_neighbors)])
+    knn_results[f'{n_trees}_trees_{leaf_size}_leaf'] = {
+        'predict_time': approx_time,
+        'neighbor_recall': neighbor_recall,
+        'agreement': np.mean(approx_pred == exact_pred),
+        'recall': metrics.recall_score(y_test, approx_pred)
+    }
+
+pd.DataFrame(knn_results).T
+
+
+# The index is stored in the attributes of the fitted model, so it is saved and loaded (memory-mapped) together with it:
+
+# In[ ]:
+
+
+from scoring_utils import save_pipeline, load_pipeline
+
+save_pipeline(approx_knn, 'approx_knn.joblib')
+approx_knn = load_pipeline('approx_knn.joblib')
+
+
+# The approximate model can directly replace the exact one in the stacking ensemble. As the other base models did not change, only the new k-nearest neighbours model and its out-of-fold predictions are fitted, and we compare both ensembles:
+
+# In[ ]:
+
+
+approx_clf_list = [
+    (name, ApproximateKNeighborsClassifier(n_trees=10, leaf_size=30, 
+                                           random_state=RANDOM_STATE)) 
+    if name == 'knn' else (name, model) 
+    for name, model in clf_list
+]
+
+stack_results = {}
+for name, estimators in [('exact_knn', clf_list), 
+                         ('approximate_knn', approx_clf_list)]:
+    stack_clf.set_params(estimators=estimators, final_estimator=lr)
+    stack_clf.fit(X_train, y_train)
+    start = time.perf_counter()
+    y_pred = stack_clf.predict(X_test)
+    stack_results[name] = {
+        'predict_time': time.perf_counter() - start,
+        'recall': metrics.recall_score(y_test, y_pred)
+    }
+
+pd.DataFrame(stack_results).T
+
+
 # ## Investigating the feature importance
 
 # ### Getting Ready
@@ -537,7 +1241,10 @@ print(f"The stacked ensemble's recall score: {recall:.4f}")
 
 # from sklearn.inspection import permutation_importance
 from sklearn.base import clone 
-from eli5.sklearn import PermutationImportance
+from joblib import Parallel, delayed, effective_n_jobs
+import joblib
+import json
+import os
 
 
 # 2. Extract the classifier and preprocessor from the pipeline:
@@ -545,6 +1252,8 @@ from eli5.sklearn import PermutationImportance
 # In[10]:
 
 
+rf_pipeline = fitted_pipelines['random_forest']
+
 # in case we have the fitted grid search object `rf_rs`, we extract the best pipeline
 # rf_pipeline = rf_rs.best_estimator_
 
@@ -670,15 +1379,146 @@ print(f'Top 10 features account for {100 * rf_feat_imp.head(10).mdi.sum():.2f}%
 print(f'Top {rf_feat_imp[rf_feat_imp.cumul_importance_mdi <= 0.95].shape[0]} features account for 95% of importance.')
 
 
-# 7. Calculate and plot permutation importance:
+# 7. Define a function for calculating the permutation feature importance:
+
+# In[ ]:
+
+
+def permutation_scores(model, X, y, tasks, batch_size, 
+                       scoring=metrics.accuracy_score):
+    '''
+    Function for scoring the model on data with permuted columns. 
+    A single working buffer holding `batch_size` stacked copies of X 
+    is allocated once and reused for all the tasks. The permutations 
+    of a column are scored in batches, using a single `predict` call.
+    
+    Parameters
+    ----------
+    model : scikit-learn's model
+        The fitted estimator
+    X : np.ndarray
+        Features for scoring the model
+    y : np.ndarray
+        The target
+    tasks : list
+        List of tuples (column index, seeds of the permutations), 
+        the number of seeds cannot exceed `batch_size`
+    batch_size : int
+        Maximum number of permutations scored at once
+    scoring : function
+        Metric taking the true and predicted values
+        
+    Returns
+    -------
+    scores : list
+        List containing an array of scores for each task
+    '''
+    
+    n_rows = len(X)
+    X_work = np.tile(X, (batch_size, 1))
+    scores = []
+    
+    for col_ind, seeds in tasks:
+        n_perms = len(seeds)
+        for batch_ind, seed in enumerate(seeds):
+            rows = slice(batch_ind * n_rows, (batch_ind + 1) * n_rows)
+            permutation = np.random.RandomState(seed).permutation(n_rows)
+            X_work[rows, col_ind] = X[permutation, col_ind]
+        
+        y_pred = model.predict(X_work[:n_perms * n_rows])
+        scores.append(np.array([
+            scoring(y, y_pred[batch_ind * n_rows:(batch_ind + 1) * n_rows])
+            for batch_ind in range(n_perms)
+        ]))
+        
+        # restore the original column
+        for batch_ind in range(n_perms):
+            rows = slice(batch_ind * n_rows, (batch_ind + 1) * n_rows)
+            X_work[rows, col_ind] = X[:, col_ind]
+    
+    return scores
+
+
+def permutation_feat_imp(model, X, y, n_repeats=25, batch_size=5,
+                         n_jobs=-1, random_state=42, 
+                         scoring=metrics.accuracy_score):
+    '''
+    Function for calculating the permutation feature importance, i.e., 
+    the decrease of the score after randomly shuffling a column.
+    The (column, batch of permutations) pairs are split evenly between 
+    the parallel processes.
+    
+    Parameters
+    ----------
+    model : scikit-learn's model
+        The fitted estimator
+    X : pd.DataFrame
+        Features for scoring the model
+    y : pd.Series
+        The target
+    n_repeats : int
+        Number of permutations of each column
+    batch_size : int
+        Maximum number of permutations scored at once. Each process 
+        allocates a buffer of `batch_size` times the size of X.
+    n_jobs : int
+        Number of parallel processes
+    random_state : int
+        Random state for reproducibility
+    scoring : function
+        Metric taking the true and predicted values
+        
+    Returns
+    -------
+    feat_imp : pd.DataFrame
+        DataFrame with the mean and the standard deviation of 
+        the importance of each column of X
+    '''
+    
+    X_values, y_values = np.asarray(X), np.asarray(y)
+    n_features = X_values.shape[1]
+    benchmark_score = scoring(y_values, model.predict(X_values))
+    
+    # each permutation has its own seed, so the results depend neither 
+    # on the number of processes nor on the batch size
+    seeds = np.random.RandomState(random_state).randint(
+        np.iinfo(np.int32).max, size=(n_features, n_repeats)
+    )
+    tasks = [(col_ind, seeds[col_ind, start:start + batch_size])
+             for col_ind in range(n_features)
+             for start in range(0, n_repeats, batch_size)]
+    
+    n_jobs = min(effective_n_jobs(n_jobs), len(tasks))
+    task_chunks = [tasks[ind::n_jobs] for ind in range(n_jobs)]
+    chunk_scores = Parallel(n_jobs=n_jobs)(
+        delayed(permutation_scores)(model, X_values, y_values, chunk, 
+                                    batch_size, scoring)
+        for chunk in task_chunks
+    )
+    
+    scores = [[] for _ in range(n_features)]
+    for chunk, chunk_score in zip(task_chunks, chunk_scores):
+        for (col_ind, _), task_scores in zip(chunk, chunk_score):
+            scores[col_ind].append(task_scores)
+    importances = benchmark_score - np.array([np.concatenate(col_scores) 
+                                              for col_scores in scores])
+    
+    feat_imp = pd.DataFrame({'permutation': importances.mean(axis=1), 
+                             'permutation_std': importances.std(axis=1)},
+                            index=X.columns)
+    
+    return feat_imp
+
+
+# 8. Calculate and plot permutation importance:
 
 # In[34]:
 
 
-perm = PermutationImportance(rf_classifier, n_iter = 25, 
-                             random_state=42)
-perm.fit(X_train_preprocessed, y_train)
-rf_feat_imp['permutation'] = perm.feature_importances_
+perm_feat_imp = permutation_feat_imp(rf_classifier, X_train_preprocessed, 
+                                     y_train, n_repeats=25, 
+                                     random_state=42)
+rf_feat_imp = rf_feat_imp.join(perm_feat_imp)
 
 
 # In[35]:
@@ -692,14 +1532,63 @@ plt.savefig('images/ch9_im9.png', dpi=300)
 plt.show()
 
 
-# 8. Define a function for calculating the drop-column feature importance:
+# 9. Define a function for calculating the drop-column feature importance:
 
 # In[36]:
 
 
-def drop_col_feat_imp(model, X, y, random_state = 42):
+def drop_col_score(model, X, y, X_valid, y_valid, drop_ind=None, 
+                   random_state=42, checkpoint_path=None):
+    '''
+    Function for fitting a clone of the model without a selected column 
+    and scoring it on the validation data.
+    
+    Parameters
+    ----------
+    model : scikit-learn's model
+        Object representing the estimator with selected hyperparameters.
+    X, y : np.ndarray
+        Features and target for training the model
+    X_valid, y_valid : np.ndarray
+        Features and target for scoring the model
+    drop_ind : int
+        Position of the column to drop, None for the benchmark model
+    random_state : int
+        Random state for reproducibility
+    checkpoint_path : str
+        Path of the file storing the score, None for no checkpointing
+        
+    Returns
+    -------
+    score : float
+        The score of the model without the selected column
+    '''
+    
+    if drop_ind is not None:
+        keep = np.arange(X.shape[1]) != drop_ind
+        # the column is dropped once, for both fitting and scoring
+        X, X_valid = X[:, keep], X_valid[:, keep]
+    
+    model_clone = clone(model)
+    model_clone.random_state = random_state
+    model_clone.fit(X, y)
+    score = model_clone.score(X_valid, y_valid)
+    
+    if checkpoint_path is not None:
+        with open(checkpoint_path + '.tmp', 'w') as f:
+            json.dump({'score': score}, f)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+    
+    return score
+
+
+def drop_col_feat_imp(model, X, y, random_state = 42, 
+                      X_valid=None, y_valid=None, n_jobs=-1, 
+                      checkpoint_dir=None):
     '''
     Function for calculating the drop column feature importance.
+    The models without each of the columns are fitted in parallel 
+    processes, which share the read-only (memory-mapped) feature array.
     
     Parameters
     ----------
@@ -711,33 +1600,72 @@ def drop_col_feat_imp(model, X, y, random_state = 42):
         The target
     random_state : int
         Random state for reproducibility
+    X_valid : pd.DataFrame
+        Features for scoring the models, by default the training features
+    y_valid : pd.Series
+        Target for scoring the models, by default the training target
+    n_jobs : int
+        Number of parallel processes
+    checkpoint_dir : str
+        Directory in which the score of each finished model is stored. 
+        When the calculations are interrupted, calling the function again
+        reuses the stored scores. The files are keyed by the hash of the 
+        hyperparameters of the model, the data and the random state, so
+        the scores of a different model or data are never reused.
         
     Returns
     -------
-    importances : list
-        List containing the calculated feature importances in the order of appearing in X
+    importances : pd.Series
+        The calculated feature importances, indexed by the columns of X
     
     '''
     
-    model_clone = clone(model)
-    model_clone.random_state = random_state
-    model_clone.fit(X, y)
-    benchmark_score = model_clone.score(X, y)
+    X_values, y_values = np.asarray(X), np.asarray(y)
+    if X_valid is None:
+        X_valid_values, y_valid_values = X_values, y_values
+    else:
+        X_valid_values, y_valid_values = np.asarray(X_valid), np.asarray(y_valid)
+    
+    # None indicates the benchmark model using all the columns
+    drop_inds = [None] + list(range(X_values.shape[1]))
+    scores = {}
+    
+    checkpoint_paths = dict.fromkeys(drop_inds)
     
-    importances = []
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        key = joblib.hash((type(model).__name__, model.get_params(), 
+                           X_values, y_values, X_valid_values, 
+                           y_valid_values, random_state))
+        for drop_ind in drop_inds:
+            file_path = os.path.join(checkpoint_dir, 
+                                     f'{key}_{drop_ind}.json')
+            checkpoint_paths[drop_ind] = file_path
+            if os.path.exists(file_path):
+                with open(file_path) as f:
+                    scores[drop_ind] = json.load(f)['score']
     
-    for col in X.columns:
-        model_clone = clone(model)
-        model_clone.random_state = random_state
-        model_clone.fit(X.drop(col, axis = 1), y)
-        drop_col_score = model_clone.score(X.drop(col, axis = 1), 
-                                           y)
-        importances.append(benchmark_score - drop_col_score)
+    drop_inds_left = [ind for ind in drop_inds if ind not in scores]
+    new_scores = Parallel(n_jobs=n_jobs)(
+        delayed(drop_col_score)(model, X_values, y_values, 
+                                X_valid_values, y_valid_values, 
+                                drop_ind, random_state, 
+                                checkpoint_paths[drop_ind])
+        for drop_ind in drop_inds_left
+    )
+    scores.update(zip(drop_inds_left, new_scores))
+    
+    benchmark_score = scores[None]
+    columns = (X.columns if hasattr(X, 'columns') 
+               else range(X_values.shape[1]))
+    importances = pd.Series([benchmark_score - scores[ind] 
+                             for ind in range(X_values.shape[1])], 
+                            index=columns)
     
     return importances
 
 
-# 9. Calculate and plot the drop-column feature importance:
+# 10. Calculate and plot the drop-column feature importance:
 
 # In[39]:
 
@@ -746,7 +1674,8 @@ rf_feat_imp['drop_column'] = drop_col_feat_imp(
     rf_classifier, 
     X_train_preprocessed, 
     y_train, 
-    random_state = 42
+    random_state = 42,
+    checkpoint_dir='drop_column_checkpoint'
 )
 
 
@@ -790,6 +1719,7 @@ from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier
 from collections import Counter
 from chapter_9_utils import performance_evaluation_report
+from resampling_utils import run_resampling_experiments, resample_cached
 
 
 # 2. Load and prepare data:
@@ -803,6 +1733,7 @@ X = df.copy()
 y = X.pop('Class')
 
 RANDOM_STATE = 42
+RESAMPLING_CACHE = 'resampling_cache'
 
 X_train, X_test, y_train, y_test = train_test_split(X, y, 
                                                     test_size=0.2, 
@@ -816,127 +1747,103 @@ X_train, X_test, y_train, y_test = train_test_split(X, y,
 y.value_counts(normalize=True)
 
 
-# 3. Train the baseline model:
+# 3. Define the experiments. Each of them pairs a model with the sampler applied to the training data (None for the original data). We compare the baseline Random Forest, the Random Forest trained on the undersampled and oversampled data (using random sampling, SMOTE and ADASYN) and the Random Forest using sample weights:
 
 # In[26]:
 
 
-rf = RandomForestClassifier(random_state=RANDOM_STATE, n_jobs=-1)
-rf.fit(X_train, y_train)
-
-
-# In[27]:
-
-
-rf_perf = performance_evaluation_report(rf, X_test, y_test, 
-                                        show_plot=True, 
-                                        show_pr_curve=True)
-
-
-# In[28]:
-
-
-rf_perf
-
-
-# 4. Undersample the data and train a Random Forest Classifier:
-
-# In[29]:
-
+rf = RandomForestClassifier(random_state=RANDOM_STATE)
+rf_cw = RandomForestClassifier(random_state=RANDOM_STATE, 
+                               class_weight='balanced')
 
 rus = RandomUnderSampler(random_state=RANDOM_STATE)
-X_rus, y_rus = rus.fit_resample(X_train, y_train)
-print(f'The new class proportions are: {dict(Counter(y_rus))}')
-
-rf.fit(X_rus, y_rus)
-rf_rus_perf = performance_evaluation_report(rf, X_test, y_test, 
-                                            show_plot=True, 
-                                            show_pr_curve=True)
-
-
-# In[30]:
-
-
-rf_rus_perf
-
-
-# 5. Oversample the data and train a Random Forest Classifier:
-
-# In[31]:
-
-
 ros = RandomOverSampler(random_state=RANDOM_STATE)
-X_ros, y_ros = ros.fit_resample(X_train, y_train)
-print(f'The new class proportions are: {dict(Counter(y_ros))}')
-
-rf.fit(X_ros, y_ros)
-rf_ros_perf = performance_evaluation_report(rf, X_test, y_test, 
-                                            show_plot=True, 
-                                            show_pr_curve=True)
 
+experiments = {
+    'random_forest': (rf, None),
+    'undersampled rf': (rf, rus),
+    'oversampled_rf': (rf, ros),
+    'smote': (rf, SMOTE(random_state=RANDOM_STATE)),
+    'adasyn': (rf, ADASYN(random_state=RANDOM_STATE)),
+    'random_forest_cw': (rf_cw, None)
+}
 
-# In[32]:
 
+# 4. Run all the experiments in parallel, caching the resampled datasets:
+# 
+# `run_resampling_experiments` trains the models in parallel worker processes and caches each resampled dataset on disk (keyed by the configuration of the sampler and the hash of the data), so rerunning the notebook only loads them instead of resampling the data again. It returns the table with the performance and the fitted models.
 
-rf_ros_perf
+# In[27]:
 
 
-# 6. Oversample using SMOTE:
+performance_results, fitted_models = run_resampling_experiments(
+    experiments, X_train, y_train, X_test, y_test, 
+    performance_evaluation_report, cache_dir=RESAMPLING_CACHE, 
+    return_estimators=True
+)
+performance_results
 
-# In[33]:
 
+# 5. Inspect the class proportions of the resampled datasets, which are loaded from the cache:
 
-X_smote, y_smote = SMOTE(random_state=RANDOM_STATE).fit_resample(X_train, y_train)
-print(f'The new class proportions are: {dict(Counter(y_smote))}')
-rf.fit(X_smote, y_smote)
-rf_smote_perf = performance_evaluation_report(rf, X_test, y_test, 
-                                              show_plot=True, 
-                                              show_pr_curve=True)
+# In[28]:
 
 
-# In[34]:
+for name, (_, sampler) in experiments.items():
+    if sampler is not None:
+        _, y_resampled = resample_cached(sampler, X_train, y_train, 
+                                         cache_dir=RESAMPLING_CACHE)
+        print(f'{name} - the new class proportions are: {dict(Counter(y_resampled))}')
 
 
-rf_smote_perf
+# 6. Plot the performance of the fitted models (the models are not fitted again, only their predictions on the test set are evaluated):
 
+# In[29]:
 
-# 7. Oversample using ADASYN:
 
-# In[35]:
+for name, fitted_model in fitted_models.items():
+    performance_evaluation_report(fitted_model, X_test, y_test, 
+                                  show_plot=True, 
+                                  show_pr_curve=True)
+    plt.suptitle(name)
+    plt.show()
 
 
-X_adasyn, y_adasyn = ADASYN(random_state=RANDOM_STATE).fit_resample(X_train, y_train)
-print(f'The new class proportions are: {dict(Counter(y_adasyn))}')
-rf.fit(X_adasyn, y_adasyn)
-rf_adasyn_perf = performance_evaluation_report(rf, X_test, y_test, 
-                                               show_plot=True, 
-                                               show_pr_curve=True)
+# Oversampling copies the entire training set and duplicates the observations of the minority class until the classes are balanced, which almost doubles the memory before training the model. As the random samplers only select rows, we can instead get the indices of the resampled rows and let every tree of the forest draw its bootstrap sample from them. `fit_forest_on_indices` trains a forest identical to the one trained on the oversampled data, without copying any rows. This holds for the default `min_samples_leaf`, `min_samples_split` and `max_leaf_nodes`, as these limits count the rows and not their weights (other values raise an error). Alternatively, `get_sample_weights` converts the resampling to the number of copies of each row, which can be passed as `sample_weight` to any model (e.g., `BalancedRandomForestClassifier`).
 
+# In[ ]:
 
-# In[36]:
 
+from resampling_utils import get_sample_indices, fit_forest_on_indices
 
-rf_adasyn_perf
+ros_indices = get_sample_indices(ros, y_train)
+rf_vros = fit_forest_on_indices(rf, X_train, y_train, ros_indices)
+rf_vros_perf = performance_evaluation_report(rf_vros, X_test, y_test)
 
+print('Same performance as the oversampled rf: '
+      f'{rf_vros_perf == performance_results.loc["oversampled_rf"].to_dict()}')
 
-# 8. Use sample weights in the Random Forest Classifier:
 
-# In[37]:
+# The oversamplers of `imbalanced-learn` copy the data a few times (the original data, the synthetic samples and their concatenation), all in float64. `FastSMOTE` and `FastADASYN` generate the same samples, but write the original and the synthetic ones into a single array, in batches. With `dtype=np.float32`, they also halve the memory, as the neighbour search runs on the float32 data directly. This keeps oversampling tractable for much larger datasets. We compare them with the datasets resampled by `imbalanced-learn`, loaded from the cache:
 
+# In[ ]:
 
-rf_cw = RandomForestClassifier(random_state=RANDOM_STATE, 
-                               class_weight='balanced',
-                               n_jobs=-1)
-rf_cw.fit(X_train, y_train)
-rf_cw_perf = performance_evaluation_report(rf_cw, X_test, y_test, 
-                                           show_plot=True, 
-                                           show_pr_curve=True)
 
+import numpy as np
+from resampling_utils import FastSMOTE, FastADASYN
 
-# In[38]:
+X_smote, _ = resample_cached(SMOTE(random_state=RANDOM_STATE), 
+                             X_train, y_train, cache_dir=RESAMPLING_CACHE)
+X_adasyn, _ = resample_cached(ADASYN(random_state=RANDOM_STATE), 
+                              X_train, y_train, cache_dir=RESAMPLING_CACHE)
 
+X_smote_fast, y_smote_fast = FastSMOTE(random_state=RANDOM_STATE).fit_resample(X_train, y_train)
+print(f'Same samples as SMOTE: {np.array_equal(X_smote_fast.values, X_smote.values)}')
 
-rf_cw_perf
+X_adasyn_32, y_adasyn_32 = FastADASYN(random_state=RANDOM_STATE, 
+                                      dtype=np.float32).fit_resample(X_train, y_train)
+print(f'Memory of the ADASYN data: {X_adasyn.memory_usage().sum() / 1024 ** 2:.1f} MB, '
+      f'in float32: {X_adasyn_32.memory_usage().sum() / 1024 ** 2:.1f} MB')
 
 
 # ### There's more
@@ -949,7 +1856,7 @@ rf_cw_perf
 from imblearn.ensemble import BalancedRandomForestClassifier
 
 
-# 2. Train the `BalancedRandomForestClassifier`:
+# 2. Train the `BalancedRandomForestClassifier`, also with balanced classes, in the same way:
 
 # In[40]:
 
@@ -957,46 +1864,34 @@ from imblearn.ensemble import BalancedRandomForestClassifier
 balanced_rf = BalancedRandomForestClassifier(
     random_state=RANDOM_STATE
 )
-
-balanced_rf.fit(X_train, y_train)
-balanced_rf_perf = performance_evaluation_report(balanced_rf, 
-                                                 X_test, y_test, 
-                                                 show_plot=True, 
-                                                 show_pr_curve=True)
-
-
-# 3. Train the `BalancedRandomForestClassifier` with balanced classes:
-
-# In[41]:
-
-
 balanced_rf_cw = BalancedRandomForestClassifier(
     random_state=RANDOM_STATE, 
-    class_weight='balanced',
-    n_jobs=-1
+    class_weight='balanced'
 )
 
-balanced_rf_cw.fit(X_train, y_train)
-balanced_rf_cw_perf = performance_evaluation_report(balanced_rf_cw, 
-                                                    X_test, y_test, 
-                                                    show_plot=True, 
-                                                    show_pr_curve=True)
+balanced_experiments = {'balanced_random_forest': (balanced_rf, None),
+                        'balanced_random_forest_cw': (balanced_rf_cw, None)}
 
+balanced_results, balanced_models = run_resampling_experiments(
+    balanced_experiments, X_train, y_train, X_test, y_test, 
+    performance_evaluation_report, cache_dir=RESAMPLING_CACHE, 
+    return_estimators=True
+)
 
-# 4. Group the performance results into a DataFrame:
+for name, fitted_model in balanced_models.items():
+    performance_evaluation_report(fitted_model, X_test, y_test, 
+                                  show_plot=True, 
+                                  show_pr_curve=True)
+    plt.suptitle(name)
+    plt.show()
+
+
+# 3. Group the performance results into a DataFrame:
 
 # In[42]:
 
 
-performance_results = {'random_forest': rf_perf,
-                       'undersampled rf': rf_rus_perf,
-                       'oversampled_rf': rf_ros_perf,
-                       'smote': rf_smote_perf,
-                       'adasyn': rf_adasyn_perf,
-                       'random_forest_cw': rf_cw_perf,
-                       'balanced_random_forest': balanced_rf_perf,
-                       'balanced_random_forest_cw': balanced_rf_cw_perf}
-pd.DataFrame(performance_results).T
+pd.concat([performance_results, balanced_results])
 
 
 # ## Bayesian Hyperparameter Optimization
@@ -1012,10 +1907,13 @@ import pandas as pd
 import pickle
 from sklearn.model_selection import train_test_split
 from hyperopt import hp, fmin, tpe, STATUS_OK, Trials
-from sklearn.model_selection import (cross_val_score, 
+from hyperopt.early_stop import no_progress_loss
+from sklearn.model_selection import (cross_validate, 
                                      StratifiedKFold)
 from lightgbm import LGBMClassifier
 from chapter_9_utils import performance_evaluation_report
+from tuning_utils import parallel_fmin, TrialStore
+from joblib import cpu_count
 import pickle
 
 
@@ -1026,6 +1924,8 @@ import pickle
 
 N_FOLDS = 5
 MAX_EVALS = 200
+# each of the concurrent trials runs its folds in parallel
+N_PARALLEL = max(1, cpu_count() // N_FOLDS)
 
 
 # 3. Load and prepare the data:
@@ -1049,19 +1949,23 @@ X_train, X_test, y_train, y_test = train_test_split(X, y,
 # In[71]:
 
 
-def objective(params, n_folds = N_FOLDS, random_state=42):
+def objective(params, X, y, n_folds=N_FOLDS, random_state=42, 
+              n_jobs=N_FOLDS):
     
     model = LGBMClassifier(**params)
-    model.set_params(random_state=random_state)
+    # the cores are already shared by the folds and the concurrent trials
+    model.set_params(random_state=random_state, n_jobs=1)
     
     k_fold = StratifiedKFold(n_folds, shuffle=True, 
                              random_state=random_state)
     
-    metrics = cross_val_score(model, X_train, y_train, 
-                              cv=k_fold, scoring='recall')
-    loss = -1 * metrics.mean()
+    scores = cross_validate(model, X, y, cv=k_fold, 
+                            scoring='recall', n_jobs=n_jobs)
+    loss = -1 * scores['test_score'].mean()
     
-    return {'loss': loss, 'params': params, 'status': STATUS_OK}
+    return {'loss': loss, 'params': params, 'status': STATUS_OK, 
+            'fold_scores': scores['test_score'], 
+            'fit_time': scores['fit_time'].sum()}
 
 
 # 5. Define the search space:
@@ -1080,17 +1984,19 @@ lgbm_param_grid = {
 }
 
 
-# 6. Run the Bayesian optimization:
+# 6. Run the Bayesian optimization. In each round, TPE proposes `N_PARALLEL` sets of hyperparameters, which are evaluated concurrently in separate processes. The search stops early if the best loss did not improve for 10 rounds, i.e., `10 * N_PARALLEL` trials (the early stopping counts the trials). Every finished trial is immediately saved in a SQLite database, so rerunning the cell after an interruption resumes the search (and other processes can contribute to the same study):
 
 # In[ ]:
 
 
-trials = Trials()
-best_set = fmin(fn= objective,
-                space= lgbm_param_grid,
-                algo= tpe.suggest,
-                max_evals = MAX_EVALS,
-                trials= trials)
+store = TrialStore('hyperopt_trials.db', study_name='lgbm_recall')
+best_set = parallel_fmin(fn=objective,
+                         space=lgbm_param_grid,
+                         max_evals=MAX_EVALS,
+                         n_parallel=N_PARALLEL,
+                         early_stop_fn=no_progress_loss(10 * N_PARALLEL),
+                         fn_kwargs={'X': X_train, 'y': y_train},
+                         store=store)
 
 
 # In[73]:
@@ -1161,28 +2067,21 @@ plt.show()
 # In[50]:
 
 
-from pandas.io.json import json_normalize
 from hyperopt.pyll.stochastic import sample
 
 
 # In[51]:
 
 
-import pickle 
-trials = pickle.load(open("trials_final.p", "rb"))
+store = TrialStore('hyperopt_trials.db', study_name='lgbm_recall')
 
 
-# 2. Parse all the information from `trials.results` into a DataFrame:
+# 2. Load the trials into a DataFrame, with a column for each hyperparameter and fold score:
 
 # In[52]:
 
 
-results_df = pd.DataFrame(trials.results)
-params_df = json_normalize(results_df['params'])
-
-results_df = pd.concat([results_df.drop('params', axis=1), params_df], 
-                       axis=1)
-results_df['iteration'] = np.arange(len(results_df)) + 1
+results_df = store.to_frame()
 results_df.sort_values('loss')
 
 
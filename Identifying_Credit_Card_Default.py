@@ -38,73 +38,13 @@ import random
 # In[ ]:
 
 
-df = pd.read_excel('default of credit card clients.xls', skiprows=1, index_col=0)
+from data_utils import prepare_credit_card_default
 
-
-# In[ ]:
-
-
-# loading the data from Excel
-df = pd.read_excel('default of credit card clients.xls', skiprows=1, index_col=0)
-
-# rename columns
-df.columns = df.columns.str.lower().str.replace(" ", "_")
-
-months = ['sep', 'aug', 'jul', 'jun', 'may', 'apr']
-variables = ['payment_status', 'bill_statement', 'previous_payment']
-new_column_names = [x + '_' + y for x in variables for y in months]
-rename_dict = {x: y for x, y in zip(df.loc[:, 'pay_0':'pay_amt6'].columns, new_column_names)}
-df.rename(columns=rename_dict, inplace=True)
-
-
-# creating dicts to map number to strings
-gender_dict = {1: 'Male', 
-               2: 'Female'}
-education_dict = {0: 'Others',
-                  1: 'Graduate school', 
-                  2: 'University', 
-                  3: 'High school', 
-                  4: 'Others',
-                  5: 'Others',
-                  6: 'Others'}
-marital_status_dict = {0: 'Others', 
-                       1: 'Married', 
-                       2: 'Single', 
-                       3: 'Others'}
-payment_status = {-2: 'Unknown',
-                  -1: 'Payed duly',
-                  0: 'Unknown',
-                  1: 'Payment delayed 1 month',
-                  2: 'Payment delayed 2 months',
-                  3: 'Payment delayed 3 months',
-                  4: 'Payment delayed 4 months',
-                  5: 'Payment delayed 5 months',
-                  6: 'Payment delayed 6 months',
-                  7: 'Payment delayed 7 months',
-                  8: 'Payment delayed 8 months',
-                  9: 'Payment delayed >= 9 months'}
-
-# # map numbers to strings
-df.sex = df.sex.map(gender_dict)
-df.education = df.education.map(education_dict)
-df.marriage = df.marriage.map(marital_status_dict)
-
-for column in [x for x in df.columns if ('status' in x)]:
-    df[column] = df[column].map(payment_status)
-
-# define the ratio of missing values to introduce
-RATIO_MISSING = 0.005
-
-# input missing values to selected columns
-random_state = np.random.RandomState(42)
-for column in ['sex', 'education', 'marriage', 'age']:
-    df.loc[df.sample(frac=RATIO_MISSING, random_state=random_state).index, column] = ''
-
-# reset index
-df.reset_index(drop=True, inplace=True)
-
-# save to csv
-df.to_csv('credit_card_default.csv')
+# the workbook is read in chunks: each chunk gets renamed columns, mapped 
+# categories and missing values before being appended to the csv
+prepare_credit_card_default('default of credit card clients.xls', 
+                            'credit_card_default.csv', 
+                            chunksize=10000)
 
 
 # In[3]:
@@ -211,6 +151,41 @@ get_df_memory_usage(df_cat2)
 df_cat.equals(df_cat2)
 
 
+# Alternatively, we can use the columnar cache. The CSV file is parsed only once and stored as a Feather file with the categorical columns already encoded, so every later load skips the parsing. The file is memory-mapped, so the numeric columns without missing values are not even copied (they are read-only), while the categorical columns are still copied once into the DataFrame:
+
+# In[ ]:
+
+
+from data_utils import load_credit_card_default
+
+df_cached = load_credit_card_default('credit_card_default.csv')
+get_df_memory_usage(df_cached)
+
+
+# Instead of writing the `column_dtypes` dictionary by hand, we can let the optimizer propose the narrowest safe dtype for each column: the smallest integer type holding the range of the values, `float32` when no value changes and `category` for strings with few unique values. The report contains the dtype and memory usage of each column before and after the conversion:
+
+# In[ ]:
+
+
+from data_utils import propose_dtypes, optimize_dtypes
+
+column_dtypes = propose_dtypes(df)
+df_opt, memory_report = optimize_dtypes(df, column_dtypes)
+
+get_df_memory_usage(df_opt)
+memory_report
+
+
+# The proposed dtypes can also be applied while reading the data:
+
+# In[ ]:
+
+
+df_opt2 = pd.read_csv('credit_card_default.csv', index_col=0, 
+                      na_values='', dtype=column_dtypes)
+get_df_memory_usage(df_opt2)
+
+
 # ## Exploratory Data Analysis
 
 # In[15]:
@@ -785,13 +760,13 @@ from sklearn.compose import ColumnTransformer
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.pipeline import Pipeline
 from chapter_8_utils import performance_evaluation_report
+from data_utils import load_credit_card_default
 
 
 # In[2]:
 
 
-df = pd.read_csv('credit_card_default.csv', index_col=0, 
-                 na_values='')
+df = load_credit_card_default('credit_card_default.csv')
 
 X = df.copy()
 y = X.pop('default_payment_next_month')
@@ -806,7 +781,7 @@ X_train, X_test, y_train, y_test = train_test_split(X, y,
 
 
 num_features = X_train.select_dtypes(include='number')                       .columns                       .to_list()
-cat_features = X_train.select_dtypes(include='object')                       .columns                       .to_list()
+cat_features = X_train.select_dtypes(include=['object', 'category'])                       .columns                       .to_list()
 
 
 # In[4]:
@@ -882,39 +857,66 @@ from sklearn.base import BaseEstimator, TransformerMixin
 
 
 class OutlierRemover(BaseEstimator, TransformerMixin):
-    def __init__(self, n_std=3):
+    def __init__(self, n_std=3, copy=True):
         self.n_std = n_std
+        self.copy = copy
+    
+    def _reset(self):
+        if hasattr(self, 'n_samples_seen_'):
+            del self.n_samples_seen_, self.mean_, self.m2_
     
     def fit(self, X, y = None):
+        # fitting from scratch discards the moments of previous calls
+        self._reset()
+        return self.partial_fit(X, y)
+    
+    def partial_fit(self, X, y = None):
+        X = np.asarray(X, dtype=np.float64)
         if np.isnan(X).any(axis=None):
             raise ValueError('''There are missing values in the array! 
                                 Please remove them.''')
-
-        mean_vec = np.mean(X, axis=0)
-        std_vec = np.std(X, axis=0)
         
-        self.upper_band_ = mean_vec + self.n_std * std_vec
-        self.lower_band_ = mean_vec - self.n_std * std_vec
+        n_new = len(X)
+        mean_new = np.mean(X, axis=0)
+        m2_new = n_new * np.var(X, axis=0)
+        
+        if not hasattr(self, 'n_samples_seen_'):
+            self.n_samples_seen_, self.mean_, self.m2_ = n_new, mean_new, m2_new
+        else:
+            # merge the running moments with the ones of the new chunk
+            n_total = self.n_samples_seen_ + n_new
+            delta = mean_new - self.mean_
+            self.mean_ = self.mean_ + delta * n_new / n_total
+            self.m2_ = (self.m2_ + m2_new + 
+                        delta ** 2 * self.n_samples_seen_ * n_new / n_total)
+            self.n_samples_seen_ = n_total
+        
+        std_vec = np.sqrt(self.m2_ / self.n_samples_seen_)
+        
+        self.upper_band_ = self.mean_ + self.n_std * std_vec
+        self.lower_band_ = self.mean_ - self.n_std * std_vec
         self.n_features_ = len(self.upper_band_)
         
         return self 
     
-    def transform(self, X, y = None):
-        X_copy = pd.DataFrame(X.copy())
+    def transform(self, X, y = None, out = None):
+        # float32 input stays float32, other types are converted to float64
+        X = np.asarray(X)
+        converted = not np.issubdtype(X.dtype, np.floating)
+        if converted:
+            X = X.astype(np.float64)
         
-        upper_band = np.repeat(
-            self.upper_band_.reshape(self.n_features_, -1), 
-            len(X_copy), 
-            axis=1).transpose()
-        lower_band = np.repeat(
-            self.lower_band_.reshape(self.n_features_, -1), 
-            len(X_copy), 
-            axis=1).transpose()
+        # without `copy` (or when the conversion already made a copy), 
+        # the values are clipped in place, otherwise np.clip allocates 
+        # the output itself
+        if out is None and (converted or not self.copy):
+            out = X
         
-        X_copy[X_copy >= upper_band] = upper_band
-        X_copy[X_copy <= lower_band] = lower_band
-        
-        return X_copy.values
+        # the bands are broadcast over the rows, without full-size copies
+        return np.clip(X, 
+                       np.asarray(self.lower_band_, dtype=X.dtype), 
+                       np.asarray(self.upper_band_, dtype=X.dtype), 
+                       out=out)
 
 
 # In[15]:
@@ -926,6 +928,153 @@ num_pipeline = Pipeline(steps=[
 ])
 
 
+# The median `SimpleImputer` needs all the data in memory. Below we define an imputer, which can also be fitted incrementally. It keeps a mergeable sketch of each column's distribution: at most `max_bins` (value, count) pairs. While the number of distinct values does not exceed `max_bins`, the median is exact. Otherwise, neighbouring values are merged into bins of (roughly) equal counts.
+
+# In[ ]:
+
+
+class StreamingMedianImputer(BaseEstimator, TransformerMixin):
+    def __init__(self, max_bins=1000):
+        self.max_bins = max_bins
+    
+    def _compress(self, values, counts):
+        # merge the sorted values into at most `max_bins` equal-count bins
+        if len(values) <= self.max_bins:
+            return values, counts
+        
+        cum_counts = np.cumsum(counts)
+        bounds = np.searchsorted(
+            cum_counts, 
+            np.linspace(0, cum_counts[-1], self.max_bins + 1)[1:-1], 
+            side='right'
+        )
+        starts = np.unique(np.r_[0, bounds])
+        starts = starts[starts < len(values)]
+        
+        bin_counts = np.add.reduceat(counts, starts)
+        bin_values = np.add.reduceat(values * counts, starts) / bin_counts
+        
+        return bin_values, bin_counts
+    
+    def _get_median(self, values, counts):
+        if len(values) == 0:
+            return np.nan
+        
+        cum_counts = np.cumsum(counts)
+        middle = (cum_counts[-1] - 1) / 2
+        lower = values[np.searchsorted(cum_counts, np.floor(middle), side='right')]
+        upper = values[np.searchsorted(cum_counts, np.ceil(middle), side='right')]
+        
+        return (lower + upper) / 2
+    
+    def fit(self, X, y = None):
+        # fitting from scratch discards the sketches of previous calls
+        if hasattr(self, 'sketches_'):
+            del self.sketches_
+        return self.partial_fit(X, y)
+    
+    def partial_fit(self, X, y = None):
+        X = np.asarray(X, dtype=np.float64)
+        
+        if not hasattr(self, 'sketches_'):
+            self.sketches_ = [(np.empty(0), np.empty(0, dtype=np.int64)) 
+                              for _ in range(X.shape[1])]
+        
+        for col_ind in range(X.shape[1]):
+            column = X[:, col_ind]
+            values, counts = np.unique(column[~np.isnan(column)], 
+                                       return_counts=True)
+            
+            # merge the sketch of the chunk with the existing one, adding
+            # up the counts of the values present in both
+            old_values, old_counts = self.sketches_[col_ind]
+            values, inverse = np.unique(np.r_[old_values, values], 
+                                        return_inverse=True)
+            counts = np.bincount(inverse, weights=np.r_[old_counts, counts])
+            
+            self.sketches_[col_ind] = self._compress(values, 
+                                                     counts.astype(np.int64))
+        
+        self.statistics_ = np.array([self._get_median(values, counts) 
+                                     for values, counts in self.sketches_])
+        
+        return self
+    
+    def transform(self, X, y = None):
+        X = np.array(X, dtype=np.float64)
+        missing = np.isnan(X)
+        X[missing] = np.take(self.statistics_, np.nonzero(missing)[1])
+        
+        return X
+
+
+# As long as a column has at most `max_bins` distinct values, the median is exact. We can verify it by fitting the imputer in several chunks sharing the same values:
+
+# In[ ]:
+
+
+rng = np.random.default_rng(42)
+# every chunk contains all the 301 distinct values
+X_chunks = [np.r_[np.arange(301), rng.integers(0, 301, 700)].reshape(-1, 1) 
+            for _ in range(6)]
+X_check = np.vstack(X_chunks).astype(float)
+
+streaming_imputer = StreamingMedianImputer(max_bins=400)
+for X_chunk in X_chunks:
+    streaming_imputer.partial_fit(X_chunk)
+
+# the sketch keeps a single bin per distinct value
+assert len(streaming_imputer.sketches_[0][0]) == 301
+assert streaming_imputer.statistics_[0] == np.median(X_check)
+
+
+# Then, we can fit the numerical pipeline chunk by chunk, for example, while reading the data from disk. Each chunk is first used to update the imputer, then imputed and used for updating the moments of the `OutlierRemover`. Please bear in mind that the first chunks are imputed using the medians available at that time.
+
+# In[ ]:
+
+
+def partial_fit_pipeline(pipeline, chunks):
+    '''
+    Function for fitting a pipeline of transformers incrementally.
+    
+    Parameters
+    ----------
+    pipeline : sklearn.pipeline.Pipeline
+        Pipeline of transformers supporting `partial_fit`
+    chunks : iterable
+        Iterable of the chunks of the data
+    
+    Returns
+    -------
+    pipeline : sklearn.pipeline.Pipeline
+        The fitted pipeline
+    '''
+    
+    for X_chunk in chunks:
+        for _, step in pipeline.steps:
+            step.partial_fit(X_chunk)
+            X_chunk = step.transform(X_chunk)
+    
+    return pipeline
+
+
+# In[ ]:
+
+
+streaming_num_pipeline = Pipeline(steps=[
+    ('imputer', StreamingMedianImputer()),
+    ('outliers', OutlierRemover())
+])
+
+# for illustration we read the entire dataset, in practice the file 
+# should only contain the training data
+csv_reader = pd.read_csv('credit_card_default.csv', na_values='', 
+                         usecols=num_features, chunksize=5000)
+chunks = (chunk[num_features] for chunk in csv_reader)
+
+partial_fit_pipeline(streaming_num_pipeline, chunks)
+
+
 # In[16]:
 
 
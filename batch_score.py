@@ -0,0 +1,229 @@
+'''
+Batch scoring of a large file of accounts with a fitted pipeline.
+
+The accounts are read in chunks (from a CSV or a Parquet file) and scored
+by a pool of worker processes, each of which loads the pipeline once. The
+main process keeps reading the next chunks and writing the finished ones
+(in the original order) while the workers compute, so I/O and scoring
+overlap and only a bounded number of chunks is kept in memory:
+
+    python batch_score.py accounts.csv light_gbm_pipeline.joblib scores.csv --index-col 0
+'''
+
+import argparse
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from joblib import effective_n_jobs
+from threadpoolctl import threadpool_limits
+
+from scoring_utils import load_pipeline
+
+# the pipeline loaded by the worker process
+_model = None
+_thread_limits = None
+
+
+def _is_parquet(path):
+    return os.path.splitext(path)[1].lower() in ['.parquet', '.pq']
+
+
+def iter_account_chunks(path, chunksize=100000, index_col=None):
+    '''
+    Reads the file of accounts in chunks.
+
+    Parameters
+    ----------
+    path : str
+        Path to a CSV or a Parquet file
+    chunksize : int
+        Number of rows in a chunk
+    index_col : int or str
+        Column of the CSV file to use as the index (identifier of the
+        accounts). The index of Parquet files is restored from their metadata.
+
+    Yields
+    ------
+    chunk : pd.DataFrame
+        Chunk of the accounts
+    '''
+    if not _is_parquet(path):
+        yield from pd.read_csv(path, index_col=index_col, chunksize=chunksize)
+        return
+
+    n_rows = 0
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+        chunk = batch.to_pandas()
+        # without a stored index the index of every batch starts at 0
+        if isinstance(chunk.index, pd.RangeIndex):
+            chunk.index = pd.RangeIndex(n_rows, n_rows + len(chunk))
+        n_rows += len(chunk)
+        yield chunk
+
+
+class ChunkWriter:
+    '''
+    Incrementally writes the scored chunks to a CSV or a Parquet file. The
+    chunks are written to a temporary file, which replaces the output only
+    after `close`, so an interrupted run never leaves a partial output.
+
+    Parameters
+    ----------
+    path : str
+        Path to the output file
+    columns : list
+        Columns of the output, used for writing an empty output (with the
+        header or schema only) when no chunk was written
+    '''
+    def __init__(self, path, columns=None):
+        self.path = path
+        self.columns = columns
+        self.tmp_path = path + '.tmp'
+        self.n_rows = 0
+        self._writer = None
+
+    def write(self, chunk):
+        if _is_parquet(self.path):
+            table = pa.Table.from_pandas(chunk, preserve_index=True)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.tmp_path, table.schema)
+            self._writer.write_table(table)
+        else:
+            chunk.to_csv(self.tmp_path, mode='a' if self.n_rows else 'w',
+                         header=not self.n_rows)
+        self.n_rows += len(chunk)
+
+    def close(self):
+        # without any chunk (e.g., empty input), the output is still created
+        if self._writer is None and not os.path.exists(self.tmp_path):
+            self.write(pd.DataFrame(columns=self.columns, dtype='float64'))
+        if self._writer is not None:
+            self._writer.close()
+        os.replace(self.tmp_path, self.path)
+
+
+def _init_worker(model_path, n_threads=None):
+    '''
+    Loads the pipeline in the worker process and limits the number of
+    threads used by the native libraries, so the workers do not
+    oversubscribe the cores. The arrays of the pipeline are memory-mapped,
+    so all the workers share a single copy.
+    '''
+    global _model, _thread_limits
+    _model = load_pipeline(model_path)
+    if n_threads is not None:
+        _thread_limits = threadpool_limits(limits=n_threads)
+
+
+def _get_output_columns(model):
+    return [f'probability_{label}' for label in model.classes_]
+
+
+def _score_chunk(chunk):
+    '''
+    Scores a chunk with the pipeline loaded by the worker process.
+    '''
+    proba = _model.predict_proba(chunk)
+    return pd.DataFrame(proba, index=chunk.index,
+                        columns=_get_output_columns(_model))
+
+
+def score_file(input_path, model_path, output_path, chunksize=100000,
+               n_jobs=-1, index_col=None, max_pending=None):
+    '''
+    Scores the file of accounts in chunks with the fitted pipeline and
+    writes the predicted probabilities incrementally.
+
+    Parameters
+    ----------
+    input_path : str
+        Path to a CSV or a Parquet file with the accounts
+    model_path : str
+        Path to the fitted pipeline saved with `save_pipeline`
+    output_path : str
+        Path to the output CSV or Parquet file
+    chunksize : int
+        Number of rows in a chunk
+    n_jobs : int
+        Number of worker processes, -1 means using all the cores. With 1,
+        the chunks are scored in the main process.
+    index_col : int or str
+        Column of the CSV file identifying the accounts
+    max_pending : int
+        Maximum number of chunks being scored or waiting for scoring.
+        By default, twice the number of workers.
+
+    Returns
+    -------
+    n_rows : int
+        Number of scored accounts
+    '''
+    n_jobs = effective_n_jobs(n_jobs)
+    max_pending = max_pending or 2 * n_jobs
+
+    # the main process only needs the names of the features and classes
+    model = load_pipeline(model_path)
+    feature_names = list(model.feature_names_in_)
+    # the pipelines do not accept empty chunks (e.g., of a file with the
+    # header only), so they are skipped
+    chunks = (chunk[feature_names] for chunk
+              in iter_account_chunks(input_path, chunksize, index_col)
+              if len(chunk))
+    writer = ChunkWriter(output_path, columns=_get_output_columns(model))
+    del model
+
+    if n_jobs == 1:
+        _init_worker(model_path)
+        for chunk in chunks:
+            writer.write(_score_chunk(chunk))
+        writer.close()
+        return writer.n_rows
+
+    n_threads = max(1, os.cpu_count() // n_jobs)
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                             initargs=(model_path, n_threads)) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_score_chunk, chunk))
+            # write the oldest chunk as soon as the queue is full
+            if len(pending) >= max_pending:
+                writer.write(pending.popleft().result())
+        while pending:
+            writer.write(pending.popleft().result())
+
+    writer.close()
+    return writer.n_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('input_path', help='CSV or Parquet file with the accounts')
+    parser.add_argument('model_path', help='Fitted pipeline saved with save_pipeline')
+    parser.add_argument('output_path', help='Output CSV or Parquet file')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--n-jobs', type=int, default=-1,
+                        help='Number of worker processes, -1 means all the cores')
+    parser.add_argument('--index-col', default=None,
+                        help='Column of the CSV file identifying the accounts')
+    args = parser.parse_args()
+
+    index_col = args.index_col
+    if index_col is not None and index_col.isdigit():
+        index_col = int(index_col)
+
+    start = time.perf_counter()
+    n_rows = score_file(args.input_path, args.model_path, args.output_path,
+                        chunksize=args.chunksize, n_jobs=args.n_jobs,
+                        index_col=index_col)
+    duration = time.perf_counter() - start
+    print(f'Scored {n_rows} accounts in {duration:.1f}s '
+          f'({n_rows / duration:.0f} accounts/s)')
+
+
+if __name__ == '__main__':
+    main()
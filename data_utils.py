@@ -0,0 +1,548 @@
+'''
+Helpers for preparing and loading the credit card default dataset.
+'''
+
+import os
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+CSV_PATH = 'credit_card_default.csv'
+
+MONTHS = ['sep', 'aug', 'jul', 'jun', 'may', 'apr']
+PAYMENT_STATUS_COLUMNS = ['payment_status_' + month for month in MONTHS]
+CATEGORICAL_COLUMNS = ['sex', 'education', 'marriage'] + PAYMENT_STATUS_COLUMNS
+
+# dicts used for mapping the numeric codes of the raw data to strings
+GENDER_DICT = {1: 'Male',
+               2: 'Female'}
+EDUCATION_DICT = {0: 'Others',
+                  1: 'Graduate school',
+                  2: 'University',
+                  3: 'High school',
+                  4: 'Others',
+                  5: 'Others',
+                  6: 'Others'}
+MARITAL_STATUS_DICT = {0: 'Others',
+                       1: 'Married',
+                       2: 'Single',
+                       3: 'Others'}
+PAYMENT_STATUS_DICT = {-2: 'Unknown',
+                       -1: 'Payed duly',
+                       0: 'Unknown',
+                       1: 'Payment delayed 1 month',
+                       2: 'Payment delayed 2 months',
+                       3: 'Payment delayed 3 months',
+                       4: 'Payment delayed 4 months',
+                       5: 'Payment delayed 5 months',
+                       6: 'Payment delayed 6 months',
+                       7: 'Payment delayed 7 months',
+                       8: 'Payment delayed 8 months',
+                       9: 'Payment delayed >= 9 months'}
+
+
+class CategoricalCodec:
+    '''
+    Codec translating the integer codes of the raw data into pandas
+    Categoricals. The translation goes through a precomputed lookup array
+    indexed by the raw code, so no Python-level mapping or intermediate
+    object strings are involved.
+
+    Parameters
+    ----------
+    mapping : dict
+        Dictionary mapping the raw integer codes to labels. Several codes
+        can share the same label.
+    '''
+    def __init__(self, mapping):
+        self.mapping = mapping
+        self.categories = list(dict.fromkeys(mapping.values()))
+        self.dtype = pd.CategoricalDtype(self.categories)
+        self.offset = min(mapping)
+
+        # position (raw code - offset) holds the category code, -1 for gaps
+        self.lookup = np.full(max(mapping) - self.offset + 1, -1, 
+                              dtype=np.int8)
+        for code, label in mapping.items():
+            self.lookup[code - self.offset] = self.categories.index(label)
+
+    def encode(self, values):
+        '''
+        Function translating raw integer codes into a Categorical.
+        Missing values and codes not present in the mapping become NaN,
+        just as with `pd.Series.map`.
+
+        Parameters
+        ----------
+        values : array-like
+            Raw integer codes
+
+        Returns
+        -------
+        categorical : pd.Categorical
+            Categorical with the labels of the mapping as categories
+        '''
+        values = np.asarray(values)
+        ind = np.full(len(values), -1, dtype=np.int64)
+        valid = ~pd.isna(values)
+        ind[valid] = values[valid].astype(np.int64) - self.offset
+        valid &= (ind >= 0) & (ind < len(self.lookup))
+
+        codes = np.full(len(values), -1, dtype=np.int8)
+        codes[valid] = self.lookup[ind[valid]]
+        return pd.Categorical.from_codes(codes, dtype=self.dtype)
+
+    def decode(self, values):
+        '''
+        Function translating labels (strings or a Categorical) into the
+        compact integer codes of the codec's categories, which can be
+        passed directly to downstream encoders.
+
+        Parameters
+        ----------
+        values : array-like
+            Labels or a Categorical, missing values are allowed
+
+        Returns
+        -------
+        codes : np.ndarray
+            Array of int8 category codes, -1 indicates a missing value
+        '''
+        # recoding an existing Categorical is done on its codes only
+        return pd.Categorical(values, dtype=self.dtype).codes
+
+
+CODECS = {'sex': CategoricalCodec(GENDER_DICT),
+          'education': CategoricalCodec(EDUCATION_DICT),
+          'marriage': CategoricalCodec(MARITAL_STATUS_DICT)}
+CODECS.update({column: CategoricalCodec(PAYMENT_STATUS_DICT) 
+               for column in PAYMENT_STATUS_COLUMNS})
+
+# columns in which missing values are introduced during the preparation
+MISSING_VALUE_COLUMNS = ['sex', 'education', 'marriage', 'age']
+RATIO_MISSING = 0.005
+
+
+def get_cache_path(csv_path):
+    '''
+    Function returning the path of the columnar cache of a CSV file.
+
+    Parameters
+    ----------
+    csv_path : str
+        Path to the CSV file
+
+    Returns
+    -------
+    cache_path : str
+        Path of the Feather file stored next to the CSV file
+    '''
+    return os.path.splitext(csv_path)[0] + '.feather'
+
+
+def write_feather_cache(df, cache_path):
+    '''
+    Function for storing a DataFrame as an uncompressed Feather file.
+    The file is first written under a temporary name and then moved into
+    place, so concurrent readers never see a partially written cache.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame to be stored
+    cache_path : str
+        Path of the Feather file
+    '''
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    # uncompressed files can be memory-mapped without decoding
+    feather.write_feather(table, tmp_path, compression='uncompressed')
+    os.replace(tmp_path, cache_path)
+
+
+def load_credit_card_default(csv_path=CSV_PATH, cache_path=None,
+                             refresh=False, dtype=None):
+    '''
+    Function for loading the prepared credit card default dataset.
+    The CSV file is parsed only once and stored as a Feather file with
+    the categorical columns encoded as `category`. Every later call
+    memory-maps the Feather file instead of parsing the text again.
+    The cache is rebuilt when the CSV file is newer than the cache.
+
+    Only the numeric columns without missing values stay backed by the 
+    memory-mapped file (they are read-only, so copy the DataFrame before 
+    modifying it in place). The categorical columns and the columns with 
+    missing values are still copied once into the DataFrame.
+
+    Parameters
+    ----------
+    csv_path : str
+        Path to the prepared CSV file
+    cache_path : str
+        Path to the Feather cache, by default the CSV path with
+        the `.feather` extension
+    refresh : boolean
+        Indicates if the cache should be rebuilt even if it is up to date
+    dtype : dict
+        Optional dtypes of selected columns, for example the output of
+        `propose_dtypes`. They are used while parsing the CSV file, 
+        so the cache stores the narrow representation.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        The prepared dataset
+    '''
+    if cache_path is None:
+        cache_path = get_cache_path(csv_path)
+
+    cache_is_stale = (
+        not os.path.exists(cache_path) or
+        (os.path.exists(csv_path) and
+         os.path.getmtime(csv_path) > os.path.getmtime(cache_path))
+    )
+
+    if refresh or cache_is_stale:
+        # the categorical columns always get the fixed dtypes of the codecs
+        csv_dtype = {col: col_dtype for col, col_dtype in (dtype or {}).items()
+                     if col not in CODECS}
+        df = pd.read_csv(csv_path, index_col=0, na_values='', dtype=csv_dtype)
+        df = df.astype({col: CODECS[col].dtype 
+                        for col in CATEGORICAL_COLUMNS if col in df.columns})
+        write_feather_cache(df, cache_path)
+
+    table = feather.read_table(cache_path, memory_map=True)
+    # every column gets its own block, so the numeric columns are not 
+    # copied into a consolidated 2D block
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+
+    if dtype is not None:
+        # a cache built with other dtypes is converted after loading
+        optimize_dtypes(df, dtype, inplace=True)
+
+    return df
+
+
+def propose_dtypes(df, max_category_ratio=0.5):
+    '''
+    Function for proposing the narrowest safe dtype for each column 
+    of a DataFrame:
+    * integers are downcast to the smallest integer type holding 
+      their range (e.g. int8 for the payment status codes),
+    * floats are downcast to float32 if no value changes,
+    * strings with few unique values become categories.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame to be inspected
+    max_category_ratio : float
+        Maximum ratio of unique values to the number of rows for 
+        a string column to be converted to a category
+
+    Returns
+    -------
+    dtypes : dict
+        Dictionary mapping the column names to the proposed dtypes, 
+        only the columns that can be narrowed are included
+    '''
+    dtypes = {}
+
+    for column in df.columns:
+        series = df[column]
+
+        if pd.api.types.is_integer_dtype(series.dtype):
+            col_min, col_max = series.min(), series.max()
+            for int_type in [np.int8, np.int16, np.int32]:
+                type_info = np.iinfo(int_type)
+                if type_info.min <= col_min and col_max <= type_info.max:
+                    if np.dtype(int_type).itemsize < series.dtype.itemsize:
+                        dtypes[column] = np.dtype(int_type).name
+                    break
+
+        elif series.dtype == np.float64:
+            values = series.to_numpy()
+            # NaN compares unequal, so it is checked separately
+            same = (values.astype(np.float32) == values) | np.isnan(values)
+            if same.all():
+                dtypes[column] = 'float32'
+
+        elif series.dtype == object:
+            if series.nunique() <= max_category_ratio * len(series):
+                dtypes[column] = 'category'
+
+    return dtypes
+
+
+def optimize_dtypes(df, dtypes=None, inplace=False):
+    '''
+    Function for converting the columns of a DataFrame to narrower dtypes
+    and reporting the memory savings. Columns are converted one at a time, 
+    so with `inplace=True` the additional memory is at most a single 
+    column.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame to be converted
+    dtypes : dict
+        Dictionary mapping the column names to the new dtypes, 
+        by default the output of `propose_dtypes`
+    inplace : boolean
+        Indicates if `df` should be modified instead of a copy
+
+    Returns
+    -------
+    df : pd.DataFrame
+        The converted DataFrame
+    report : pd.DataFrame
+        The dtype and the memory usage (MB) of each column before and
+        after the conversion
+    '''
+    if dtypes is None:
+        dtypes = propose_dtypes(df)
+    if not inplace:
+        df = df.copy()
+
+    report = pd.DataFrame({
+        'dtype_before': df.dtypes.astype(str), 
+        'memory_before': df.memory_usage(deep=True, index=False) / 1024 ** 2
+    })
+
+    for column, column_dtype in dtypes.items():
+        if df[column].dtype != column_dtype:
+            df[column] = df[column].astype(column_dtype)
+
+    report['dtype_after'] = df.dtypes.astype(str)
+    report['memory_after'] = df.memory_usage(deep=True, index=False) / 1024 ** 2
+    report['reduction'] = 1 - report['memory_after'] / report['memory_before']
+
+    return df, report
+
+
+def _iter_excel_rows(path):
+    '''
+    Generator yielding the rows of the first sheet of an Excel workbook
+    as tuples of cell values, without building a DataFrame.
+    '''
+    if path.lower().endswith('.xls'):
+        import xlrd
+        book = xlrd.open_workbook(path, on_demand=True)
+        try:
+            sheet = book.sheet_by_index(0)
+            for row_ind in range(sheet.nrows):
+                yield sheet.row_values(row_ind)
+        finally:
+            book.release_resources()
+    else:
+        import openpyxl
+        # the read-only mode streams the rows from the file
+        book = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            yield from book.worksheets[0].iter_rows(values_only=True)
+        finally:
+            book.close()
+
+
+def _iter_untyped_chunks(path, chunksize, skiprows):
+    '''
+    Generator yielding the chunks of the raw data with the dtypes inferred
+    separately for every chunk.
+    '''
+    if path.lower().endswith('.csv'):
+        yield from pd.read_csv(path, skiprows=skiprows, index_col=0,
+                               chunksize=chunksize)
+        return
+
+    rows = islice(_iter_excel_rows(path), skiprows, None)
+    header = list(next(rows))
+
+    while True:
+        chunk = pd.DataFrame(list(islice(rows, chunksize)), columns=header)
+        if chunk.empty:
+            break
+        yield chunk.set_index(header[0])
+
+
+def _get_numeric_dtypes(chunks):
+    '''
+    Finds the dtypes of the columns which are numeric in all the chunks.
+    The columns holding only whole numbers get int64 (or the nullable Int64
+    if they have missing values), the other ones float64.
+    '''
+    numeric, integral, missing = None, None, None
+    for chunk in chunks:
+        chunk_numeric = pd.Series(False, index=chunk.columns)
+        chunk_numeric[chunk.select_dtypes(include='number').columns] = True
+        values = chunk.loc[:, chunk_numeric]
+        chunk_integral = pd.Series(False, index=chunk.columns)
+        chunk_integral[values.columns] = ((values % 1 == 0) 
+                                          | values.isna()).all()
+        chunk_missing = chunk.isna().any()
+        if numeric is None:
+            numeric, integral, missing = (chunk_numeric, chunk_integral, 
+                                          chunk_missing)
+        else:
+            numeric &= chunk_numeric
+            integral &= chunk_integral
+            missing |= chunk_missing
+
+    if numeric is None:
+        return {}
+    return {column: ('float64' if not integral[column] 
+                     else 'Int64' if missing[column] else 'int64')
+            for column in numeric.index[numeric]}
+
+
+def iter_raw_chunks(path, chunksize=10000, skiprows=1):
+    '''
+    Generator for reading the raw credit card clients data in chunks.
+    Excel workbooks (`.xls`/`.xlsx`) are read row by row, CSV extracts
+    with the chunked reader of pandas. The first column is used as the
+    index, just as with `pd.read_excel(path, skiprows=1, index_col=0)`.
+
+    The file is read twice. The first pass decides the dtypes of the
+    numeric columns for the entire file (Excel does not distinguish
+    integers from floats, and pandas infers the dtypes of every chunk
+    separately), so every chunk gets the same ones: int64 for the columns
+    holding only whole numbers (the nullable Int64 if the column has
+    missing values anywhere in the file), float64 for the other ones.
+
+    `.xlsx` workbooks are streamed (the read-only mode of openpyxl). The
+    legacy `.xls` format does not support streaming, so xlrd loads the
+    entire workbook into memory (only the DataFrame is built in chunks).
+
+    Parameters
+    ----------
+    path : str
+        Path to the raw data file
+    chunksize : int
+        Maximum number of rows in a single chunk
+    skiprows : int
+        Number of rows to skip before the header
+
+    Yields
+    ------
+    chunk : pd.DataFrame
+        Chunk of the raw data
+    '''
+    dtypes = _get_numeric_dtypes(_iter_untyped_chunks(path, chunksize,
+                                                      skiprows))
+    for chunk in _iter_untyped_chunks(path, chunksize, skiprows):
+        yield chunk.astype(dtypes)
+
+
+def get_rename_dict(columns):
+    '''
+    Function for creating the mapping from the raw column names
+    (lowercased, with spaces replaced by underscores) to the names used
+    in the prepared dataset.
+
+    Parameters
+    ----------
+    columns : pd.Index
+        Columns of the raw data
+
+    Returns
+    -------
+    rename_dict : dict
+        Dictionary mapping the raw names to the new ones
+    '''
+    columns = columns.str.lower().str.replace(' ', '_')
+    variables = ['payment_status', 'bill_statement', 'previous_payment']
+    new_column_names = [x + '_' + y for x in variables for y in MONTHS]
+    raw_names = columns[columns.get_loc('pay_0'):columns.get_loc('pay_amt6') + 1]
+    return dict(zip(raw_names, new_column_names))
+
+
+def prepare_chunk(chunk, rename_dict, random_state,
+                  ratio_missing=RATIO_MISSING):
+    '''
+    Function for preparing a single chunk of the raw data. It renames
+    the columns, maps the numeric codes to categories and introduces
+    missing values into the selected columns.
+
+    Parameters
+    ----------
+    chunk : pd.DataFrame
+        Chunk of the raw data
+    rename_dict : dict
+        Mapping of the lowercased raw column names, see `get_rename_dict`
+    random_state : np.random.RandomState
+        Random state used for selecting the missing values,
+        shared between the chunks
+    ratio_missing : float
+        Ratio of missing values to introduce
+
+    Returns
+    -------
+    chunk : pd.DataFrame
+        The prepared chunk
+    '''
+    chunk.columns = chunk.columns.str.lower().str.replace(' ', '_')
+    chunk = chunk.rename(columns=rename_dict)
+
+    # map numbers to categories
+    for column in CATEGORICAL_COLUMNS:
+        chunk[column] = CODECS[column].encode(chunk[column])
+
+    for column in MISSING_VALUE_COLUMNS:
+        missing_index = chunk.sample(frac=ratio_missing,
+                                     random_state=random_state).index
+        if not isinstance(chunk[column].dtype, pd.CategoricalDtype):
+            # nullable integers are written to the csv without decimals
+            chunk[column] = chunk[column].astype('Int64')
+        chunk.loc[missing_index, column] = np.nan
+
+    return chunk
+
+
+def prepare_credit_card_default(source_path, csv_path=CSV_PATH,
+                                chunksize=10000,
+                                ratio_missing=RATIO_MISSING,
+                                random_state=42):
+    '''
+    Function for preparing the credit card default dataset from the raw
+    data in a streaming fashion. The source is read in chunks of at most
+    `chunksize` rows, each chunk is prepared separately and appended to
+    the output CSV file, so the memory usage does not depend on the size
+    of the source.
+
+    Parameters
+    ----------
+    source_path : str
+        Path to the raw data (`.xls`, `.xlsx` or `.csv`)
+    csv_path : str
+        Path to the output CSV file
+    chunksize : int
+        Maximum number of rows held in memory at once
+    ratio_missing : float
+        Ratio of missing values to introduce
+    random_state : int
+        Random state for reproducibility
+
+    Returns
+    -------
+    n_rows : int
+        Number of rows written to the output file
+    '''
+    random_state = np.random.RandomState(random_state)
+    rename_dict = None
+    n_rows = 0
+
+    with open(csv_path, 'w', newline='') as f:
+        for chunk in iter_raw_chunks(source_path, chunksize=chunksize):
+            if rename_dict is None:
+                rename_dict = get_rename_dict(chunk.columns)
+            chunk = prepare_chunk(chunk, rename_dict, random_state,
+                                  ratio_missing)
+            # continue the reset index from the previous chunk
+            chunk.index = pd.RangeIndex(n_rows, n_rows + len(chunk))
+            chunk.to_csv(f, header=(n_rows == 0))
+            n_rows += len(chunk)
+
+    return n_rows
@@ -0,0 +1,259 @@
+'''
+Approximate nearest-neighbour search with a forest of random projection
+trees, and a k-nearest neighbours classifier using it.
+'''
+
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.utils import check_random_state
+from sklearn.utils.validation import check_array, check_is_fitted
+
+
+class RandomProjectionForest:
+    '''
+    Index for approximate (Euclidean) nearest-neighbour queries.
+
+    Every tree recursively splits the points at the median of their
+    projections onto the direction between two randomly drawn points, until
+    the leaves contain between `leaf_size` and `2 * leaf_size` points. The
+    trees are balanced and complete, so they are stored as flat arrays
+    (children of the node i are the nodes 2i + 1 and 2i + 2) and a block of
+    queries descends all of them level by level in vectorized passes. The
+    candidates are the points sharing a leaf with the query in any of the
+    trees, their exact distances determine the returned neighbours.
+
+    More trees and larger leaves find more of the true neighbours at the
+    cost of slower queries (and, for the trees, a larger index).
+
+    Parameters
+    ----------
+    n_trees : int
+        Number of trees
+    leaf_size : int
+        Minimum number of points in a leaf
+    random_state : int
+        Random state used for drawing the directions
+    n_jobs : int
+        Number of threads processing the blocks of queries, -1 means using
+        all the cores
+    block_size : int
+        Number of queries in a block
+    '''
+    def __init__(self, n_trees=10, leaf_size=30, random_state=None,
+                 n_jobs=-1, block_size=128):
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        self.block_size = block_size
+
+    def _build_tree(self, X, rng):
+        n_points, n_features = X.shape
+        order = np.arange(n_points)
+        directions = np.zeros((2 ** self.depth_ - 1, n_features), dtype=X.dtype)
+        thresholds = np.zeros(2 ** self.depth_ - 1, dtype=X.dtype)
+
+        # boundaries of the segments of `order` belonging to the nodes of
+        # the current level
+        bounds = np.array([0, n_points])
+        for level in range(self.depth_):
+            first_node = 2 ** level - 1
+            new_bounds = [0]
+            for node_pos in range(2 ** level):
+                start, end = bounds[node_pos], bounds[node_pos + 1]
+                idx = order[start:end]
+                first, second = rng.choice(idx, 2, replace=False)
+                direction = X[first] - X[second]
+                if not direction.any():
+                    direction = rng.standard_normal(n_features).astype(X.dtype)
+                proj = X[idx] @ direction
+                mid = len(idx) // 2
+                part = np.argpartition(proj, mid)
+                order[start:end] = idx[part]
+                # the queries on the threshold go to the left
+                directions[first_node + node_pos] = direction
+                thresholds[first_node + node_pos] = (
+                    (proj[part[:mid]].max() + proj[part[mid]]) / 2
+                )
+                new_bounds.extend([start + mid, end])
+            bounds = np.array(new_bounds)
+
+        # members of the leaves, padded with -1 to the size of the largest one
+        leaf_sizes = np.diff(bounds)
+        leaves = np.full((len(leaf_sizes), leaf_sizes.max()), -1, dtype=np.intp)
+        for leaf_ind, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            leaves[leaf_ind, :end - start] = order[start:end]
+
+        return directions, thresholds, leaves
+
+    def fit(self, X):
+        '''
+        Builds the index.
+
+        Parameters
+        ----------
+        X : array-like
+            The indexed points
+
+        Returns
+        -------
+        self : RandomProjectionForest
+            The fitted index
+        '''
+        X = check_array(X, dtype=[np.float64, np.float32])
+        if X.shape[0] < self.leaf_size:
+            raise ValueError(f'At least leaf_size={self.leaf_size} points '
+                             f'are required, got {X.shape[0]}')
+        rng = check_random_state(self.random_state)
+        self.depth_ = int(np.floor(np.log2(X.shape[0] / self.leaf_size)))
+
+        trees = [self._build_tree(X, rng) for _ in range(self.n_trees)]
+        self.directions_ = np.stack([tree[0] for tree in trees])
+        self.thresholds_ = np.stack([tree[1] for tree in trees])
+        self.leaves_ = np.stack([tree[2] for tree in trees])
+        self.X_fit_ = X
+
+        return self
+
+    def _get_candidates(self, X):
+        '''
+        Collects the members of the leaves reached by the queries in all
+        the trees, as an array of shape (queries, trees * leaf members).
+        '''
+        candidates = []
+        for tree_ind in range(self.n_trees):
+            node = np.zeros(X.shape[0], dtype=np.intp)
+            for _ in range(self.depth_):
+                proj = np.einsum('ij,ij->i', X, self.directions_[tree_ind, node])
+                go_right = proj > self.thresholds_[tree_ind, node]
+                node = 2 * node + 1 + go_right
+            candidates.append(self.leaves_[tree_ind, node - (2 ** self.depth_ - 1)])
+        return np.hstack(candidates)
+
+    def _kneighbors_block(self, X, n_neighbors):
+        candidates = np.sort(self._get_candidates(X), axis=1)
+        diff = self.X_fit_[candidates] - X[:, np.newaxis, :]
+        sq_dist = np.einsum('ijk,ijk->ij', diff, diff)
+        # the padding and the points found by several trees are skipped
+        sq_dist[candidates == -1] = np.inf
+        sq_dist[:, 1:][candidates[:, 1:] == candidates[:, :-1]] = np.inf
+
+        nearest = np.argpartition(sq_dist, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        nearest_dist = np.take_along_axis(sq_dist, nearest, axis=1)
+        sort_ind = np.argsort(nearest_dist, axis=1)
+        nearest = np.take_along_axis(nearest, sort_ind, axis=1)
+
+        return (np.sqrt(np.take_along_axis(nearest_dist, sort_ind, axis=1)),
+                np.take_along_axis(candidates, nearest, axis=1))
+
+    def kneighbors(self, X, n_neighbors=5, return_distance=True):
+        '''
+        Finds the (approximate) nearest neighbours of the queries.
+
+        Parameters
+        ----------
+        X : array-like
+            The queries
+        n_neighbors : int
+            Number of neighbours, at most `leaf_size`
+        return_distance : bool
+            Whether to return the distances
+
+        Returns
+        -------
+        distances : np.ndarray
+            The Euclidean distances to the neighbours, sorted increasingly
+            (only if `return_distance` is True)
+        indices : np.ndarray
+            The indices of the neighbours in the indexed points
+        '''
+        if n_neighbors > self.leaf_size:
+            raise ValueError(f'n_neighbors={n_neighbors} must not exceed '
+                             f'leaf_size={self.leaf_size}')
+        X = check_array(X, dtype=self.X_fit_.dtype)
+        n_rows = X.shape[0]
+
+        if n_rows <= self.block_size or effective_n_jobs(self.n_jobs) == 1:
+            blocks = [self._kneighbors_block(X[start:start + self.block_size],
+                                             n_neighbors)
+                      for start in range(0, n_rows, self.block_size)]
+        else:
+            # numpy releases the GIL, so the blocks are processed in threads
+            blocks = Parallel(n_jobs=self.n_jobs, prefer='threads')(
+                delayed(self._kneighbors_block)(X[start:start + self.block_size],
+                                                n_neighbors)
+                for start in range(0, n_rows, self.block_size)
+            )
+
+        distances = np.vstack([block[0] for block in blocks])
+        indices = np.vstack([block[1] for block in blocks])
+        if return_distance:
+            return distances, indices
+        return indices
+
+
+class ApproximateKNeighborsClassifier(ClassifierMixin, BaseEstimator):
+    '''
+    k-nearest neighbours classifier (with uniform weights) finding the
+    neighbours with a `RandomProjectionForest` instead of the exact search
+    of `KNeighborsClassifier`. The index is an attribute of the fitted
+    classifier, so it is persisted (and memory-mapped) together with the
+    model by `save_pipeline`/`load_pipeline`.
+
+    Parameters
+    ----------
+    n_neighbors : int
+        Number of neighbours
+    n_trees : int
+        Number of trees of the index. More trees find more of the true
+        neighbours, but slow down the queries.
+    leaf_size : int
+        Minimum number of points in a leaf of the index, at least
+        `n_neighbors`. Larger leaves find more of the true neighbours, but
+        slow down the queries.
+    random_state : int
+        Random state used for building the index
+    n_jobs : int
+        Number of threads processing the blocks of queries
+    block_size : int
+        Number of queries in a block
+    '''
+    def __init__(self, n_neighbors=5, n_trees=10, leaf_size=30,
+                 random_state=None, n_jobs=-1, block_size=128):
+        self.n_neighbors = n_neighbors
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.random_state = random_state
+        self.n_jobs = n_jobs
+        self.block_size = block_size
+
+    def fit(self, X, y):
+        X = check_array(X, dtype=[np.float64, np.float32])
+        self.classes_, self._y = np.unique(y, return_inverse=True)
+        self.n_features_in_ = X.shape[1]
+        self.index_ = RandomProjectionForest(n_trees=self.n_trees,
+                                             leaf_size=self.leaf_size,
+                                             random_state=self.random_state,
+                                             n_jobs=self.n_jobs,
+                                             block_size=self.block_size).fit(X)
+        return self
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        check_is_fitted(self)
+        return self.index_.kneighbors(X, n_neighbors or self.n_neighbors,
+                                      return_distance=return_distance)
+
+    def predict_proba(self, X):
+        '''
+        Predicts the class probabilities as the shares of the classes
+        among the neighbours.
+        '''
+        neighbors = self.kneighbors(X, return_distance=False)
+        neighbor_labels = self._y[neighbors]
+        proba = np.stack([(neighbor_labels == label).mean(axis=1)
+                          for label in range(len(self.classes_))], axis=1)
+        return proba
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
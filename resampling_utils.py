@@ -0,0 +1,514 @@
+'''
+Helpers for the experiments with resampling imbalanced data.
+'''
+
+import os
+from abc import ABCMeta, abstractmethod
+
+import joblib
+import numpy as np
+import pandas as pd
+from imblearn.over_sampling import RandomOverSampler
+from imblearn.under_sampling import RandomUnderSampler
+from imblearn.utils import check_sampling_strategy
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.base import BaseEstimator, clone
+from sklearn.ensemble._forest import (_generate_sample_indices,
+                                      _get_n_samples_bootstrap)
+from sklearn.neighbors import NearestNeighbors
+from sklearn.utils import check_random_state
+
+
+def get_resampling_key(sampler, data_hash):
+    '''
+    Identifies a resampled dataset by the class and the hyperparameters of
+    the sampler and by the hash of the resampled data.
+
+    Parameters
+    ----------
+    sampler : object
+        The (not fitted) imbalanced-learn sampler
+    data_hash : str
+        The hash of the data, e.g., `joblib.hash((X, y))`
+
+    Returns
+    -------
+    key : str
+        The key of the resampled dataset
+    '''
+    return joblib.hash((type(sampler).__name__, sampler.get_params(), data_hash))
+
+
+def resample_cached(sampler, X, y, cache_dir='resampling_cache',
+                    data_hash=None):
+    '''
+    Resamples the data, caching the resampled dataset on disk. Later calls
+    with the same sampler and data load (memory-map) the cached dataset.
+
+    Parameters
+    ----------
+    sampler : object
+        The (not fitted) imbalanced-learn sampler
+    X : pd.DataFrame
+        The features
+    y : pd.Series
+        The target
+    cache_dir : str
+        Directory with the cached datasets
+    data_hash : str
+        The hash of the data, computed if not provided. Passing it avoids
+        hashing the same data for every sampler.
+
+    Returns
+    -------
+    X_resampled : pd.DataFrame
+        The resampled features
+    y_resampled : pd.Series
+        The resampled target
+    '''
+    if data_hash is None:
+        data_hash = joblib.hash((X, y))
+    key = get_resampling_key(sampler, data_hash)
+    path = os.path.join(cache_dir, f'{type(sampler).__name__}_{key}.joblib')
+
+    if os.path.exists(path):
+        return joblib.load(path, mmap_mode='r')
+
+    X_resampled, y_resampled = clone(sampler).fit_resample(X, y)
+
+    # the dataset is written to a temporary file first, so concurrent or
+    # interrupted runs never leave a partial file in the cache
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    joblib.dump((X_resampled, y_resampled), tmp_path)
+    os.replace(tmp_path, path)
+
+    return X_resampled, y_resampled
+
+
+class _BaseFastOverSampler(BaseEstimator, metaclass=ABCMeta):
+    '''
+    Base class of the oversamplers, which write the original and the
+    synthetic samples into a single array, allocated with the exact size.
+    '''
+    def _kneighbors(self, X_query, X_fit, query_indices, n_neighbors):
+        '''
+        Finds the neighbours of the queries, which are the points of `X_fit`
+        with the indices `query_indices`, excluding the queries themselves.
+        '''
+        # sklearn's brute-force search processes the distances in chunks
+        # (in parallel threads) and keeps float32 data in float32
+        nn = NearestNeighbors(n_neighbors=n_neighbors + 1, algorithm='brute',
+                              n_jobs=self.n_jobs)
+        neighbors = nn.fit(X_fit).kneighbors(X_query, return_distance=False)
+
+        # the query itself is dropped, or the farthest neighbour if one of
+        # its duplicates was returned instead
+        is_self = neighbors == query_indices[:, np.newaxis]
+        is_self[~is_self.any(axis=1), -1] = True
+        return neighbors[~is_self].reshape(len(neighbors), n_neighbors)
+
+    @abstractmethod
+    def _draw_samples(self, X, X_class, y, class_indices, class_sample,
+                      n_samples, random_state):
+        '''
+        Draws the synthetic samples of the class, returning the points of
+        the class (`rows`) and their neighbours (`cols`) they are generated
+        from, the steps towards the neighbours and the neighbours.
+        '''
+
+    def fit_resample(self, X, y):
+        '''
+        Oversamples the data.
+
+        Parameters
+        ----------
+        X : pd.DataFrame or np.ndarray
+            The features
+        y : pd.Series or np.ndarray
+            The target
+
+        Returns
+        -------
+        X_resampled : pd.DataFrame or np.ndarray
+            The original features followed by the synthetic samples
+        y_resampled : pd.Series or np.ndarray
+            The resampled target
+        '''
+        y_values = np.asarray(y)
+        self.sampling_strategy_ = check_sampling_strategy(
+            self.sampling_strategy, y_values, 'over-sampling'
+        )
+        dtype = np.dtype(self.dtype) if self.dtype is not None else np.float64
+        n_rows = X.shape[0]
+        random_state = check_random_state(self.random_state)
+
+        # the samples of all the classes are drawn first, so the output is
+        # allocated with the exact size. The converted features (a view of
+        # X when it already has the dtype) are released before that.
+        X_values = np.asarray(X, dtype=dtype)
+        draws = []
+        for class_sample, n_samples in self.sampling_strategy_.items():
+            if n_samples == 0:
+                continue
+            class_indices = np.flatnonzero(y_values == class_sample)
+            X_class = X_values[class_indices]
+            draws.append((class_sample, X_class) + self._draw_samples(
+                X_values, X_class, y_values, class_indices, class_sample,
+                n_samples, random_state
+            ))
+        del X_values
+
+        # the original rows are converted directly into the output
+        n_new = sum(len(draw[2]) for draw in draws)
+        X_resampled = np.empty((n_rows + n_new, X.shape[1]), dtype=dtype)
+        X_resampled[:n_rows] = X
+        y_resampled = [y_values]
+
+        position = n_rows
+        for class_sample, X_class, rows, cols, steps, neighbors in draws:
+            # the synthetic samples are generated in batches, in place
+            for start in range(0, len(rows), self.batch_size):
+                batch = slice(start, start + self.batch_size)
+                out = X_resampled[position + start:
+                                  position + start + len(rows[batch])]
+                base = X_class[rows[batch]]
+                np.take(X_class, neighbors[rows[batch], cols[batch]], axis=0,
+                        out=out)
+                out -= base
+                out *= steps[batch]
+                out += base
+
+            y_resampled.append(np.full(len(rows), class_sample,
+                                       dtype=y_values.dtype))
+            position += len(rows)
+
+        y_resampled = np.concatenate(y_resampled)
+
+        if isinstance(X, pd.DataFrame):
+            X_resampled = pd.DataFrame(X_resampled, columns=X.columns, copy=False)
+        if isinstance(y, pd.Series):
+            y_resampled = pd.Series(y_resampled, name=y.name)
+        return X_resampled, y_resampled
+
+
+class FastSMOTE(_BaseFastOverSampler):
+    '''
+    SMOTE oversampling generating the synthetic samples in batches into a
+    single preallocated array, optionally in float32. With the default
+    dtype, the samples are the same as the ones of imbalanced-learn's
+    `SMOTE` (up to ties between the distances of the neighbours).
+
+    Parameters
+    ----------
+    sampling_strategy : str, float or dict
+        The sampling strategy, as in imbalanced-learn
+    k_neighbors : int
+        Number of neighbours used for generating the samples
+    random_state : int
+        Random state used for drawing the samples
+    dtype : type
+        The dtype of the resampled features, e.g., np.float32 to halve the
+        memory. By default, float64.
+    n_jobs : int
+        Number of threads of the neighbour search
+    batch_size : int
+        Number of synthetic samples generated at once
+    '''
+    def __init__(self, sampling_strategy='auto', k_neighbors=5,
+                 random_state=None, dtype=None, n_jobs=None,
+                 batch_size=65536):
+        self.sampling_strategy = sampling_strategy
+        self.k_neighbors = k_neighbors
+        self.random_state = random_state
+        self.dtype = dtype
+        self.n_jobs = n_jobs
+        self.batch_size = batch_size
+
+    def _draw_samples(self, X, X_class, y, class_indices, class_sample,
+                      n_samples, random_state):
+        neighbors = self._kneighbors(X_class, X_class,
+                                     np.arange(len(class_indices)),
+                                     self.k_neighbors)
+
+        # the same draws as in imbalanced-learn
+        samples_indices = random_state.randint(low=0, high=neighbors.size,
+                                               size=n_samples)
+        steps = random_state.uniform(size=n_samples)[:, np.newaxis]
+        rows = np.floor_divide(samples_indices, neighbors.shape[1])
+        cols = np.mod(samples_indices, neighbors.shape[1])
+
+        return rows, cols, steps, neighbors
+
+
+class FastADASYN(_BaseFastOverSampler):
+    '''
+    ADASYN oversampling generating the synthetic samples in batches into
+    a single preallocated array, optionally in float32. The neighbours
+    in the entire dataset (the expensive part) determine how many samples
+    are generated from each point of the class. With the default dtype, the
+    samples are the same as the ones of imbalanced-learn's `ADASYN` (up to
+    ties between the distances of the neighbours).
+
+    Parameters
+    ----------
+    sampling_strategy : str, float or dict
+        The sampling strategy, as in imbalanced-learn
+    n_neighbors : int
+        Number of neighbours used for generating the samples
+    random_state : int
+        Random state used for drawing the samples
+    dtype : type
+        The dtype of the resampled features, e.g., np.float32 to halve the
+        memory. By default, float64.
+    n_jobs : int
+        Number of threads of the neighbour search
+    batch_size : int
+        Number of synthetic samples generated at once
+    '''
+    def __init__(self, sampling_strategy='auto', n_neighbors=5,
+                 random_state=None, dtype=None, n_jobs=None,
+                 batch_size=65536):
+        self.sampling_strategy = sampling_strategy
+        self.n_neighbors = n_neighbors
+        self.random_state = random_state
+        self.dtype = dtype
+        self.n_jobs = n_jobs
+        self.batch_size = batch_size
+
+    def _draw_samples(self, X, X_class, y, class_indices, class_sample,
+                      n_samples, random_state):
+        neighbors = self._kneighbors(X_class, X, class_indices,
+                                     self.n_neighbors)
+        ratio_nn = np.sum(y[neighbors] != class_sample, axis=1) / self.n_neighbors
+        if not np.sum(ratio_nn):
+            raise RuntimeError('None of the neighbours belongs to the majority '
+                               'class, ADASYN is not suited for this dataset. '
+                               'Use SMOTE instead.')
+        ratio_nn /= np.sum(ratio_nn)
+        n_samples_generate = np.rint(ratio_nn * n_samples).astype(int)
+        if not n_samples_generate.sum():
+            raise ValueError('No samples will be generated with the provided '
+                             'ratio settings.')
+
+        # the samples are generated from the neighbours within the class
+        neighbors = self._kneighbors(X_class, X_class,
+                                     np.arange(len(class_indices)),
+                                     self.n_neighbors)
+        rows = np.repeat(np.arange(len(class_indices)), n_samples_generate)
+        cols = random_state.choice(self.n_neighbors, size=len(rows))
+        steps = random_state.uniform(size=(len(rows), 1))
+
+        return rows, cols, steps, neighbors
+
+
+def get_sample_indices(sampler, y):
+    '''
+    Runs a random over- or undersampler on the target only, returning the
+    indices of the resampled rows instead of copying them. The indices are
+    the same as the `sample_indices_` of the sampler fitted to the entire
+    data, as the random samplers do not look at the features.
+
+    Parameters
+    ----------
+    sampler : RandomOverSampler or RandomUnderSampler
+        The (not fitted) sampler. The smoothed bootstrap of
+        RandomOverSampler (`shrinkage`) generates new rows, so it is not
+        supported.
+    y : array-like
+        The target
+
+    Returns
+    -------
+    sample_indices : np.ndarray
+        The indices of the rows of the resampled data
+    '''
+    if not isinstance(sampler, (RandomOverSampler, RandomUnderSampler)):
+        raise ValueError('Only RandomOverSampler and RandomUnderSampler are '
+                         f'supported, got {type(sampler).__name__}')
+    if getattr(sampler, 'shrinkage', None) is not None:
+        raise ValueError('The smoothed bootstrap (shrinkage) is not supported')
+
+    # a single column of zeros stands in for the features
+    sampler = clone(sampler)
+    sampler.fit_resample(np.zeros((len(y), 1)), np.asarray(y))
+    return sampler.sample_indices_
+
+
+def get_sample_weights(sampler, y):
+    '''
+    Converts the resampling of a random sampler to sample weights: every
+    row is weighted by the number of its copies in the resampled data (the
+    rows dropped by undersampling get zero weight). The weights can be
+    passed to any estimator supporting `sample_weight`, e.g.,
+    RandomForestClassifier or BalancedRandomForestClassifier.
+
+    Parameters
+    ----------
+    sampler : RandomOverSampler or RandomUnderSampler
+        The (not fitted) sampler
+    y : array-like
+        The target
+
+    Returns
+    -------
+    sample_weight : np.ndarray
+        The weights of the rows
+    '''
+    sample_indices = get_sample_indices(sampler, y)
+    return np.bincount(sample_indices, minlength=len(y)).astype(np.float64)
+
+
+def fit_forest_on_indices(forest, X, y, sample_indices):
+    '''
+    Fits the random forest as if it was trained on the resampled data
+    `X[sample_indices]`, without copying the rows. Every tree draws its
+    bootstrap sample from the resampled rows with the same random state as
+    the forest would, and is fitted to the original data weighted by the
+    number of times each row was drawn. The trees are therefore the same as
+    the ones fitted to the copied rows (up to the order of summing the
+    weights), as long as `min_samples_leaf`, `min_samples_split` and
+    `max_leaf_nodes` keep their default values. These limits count the
+    rows instead of their weights, so other values raise an error.
+
+    Parameters
+    ----------
+    forest : RandomForestClassifier
+        The (not fitted) forest, without `class_weight` and `oob_score` and
+        with the default `min_samples_leaf`, `min_samples_split` and
+        `max_leaf_nodes`
+    X : pd.DataFrame
+        The features
+    y : pd.Series
+        The target
+    sample_indices : np.ndarray
+        The indices of the rows of the resampled data, e.g., from
+        `get_sample_indices`
+
+    Returns
+    -------
+    forest : RandomForestClassifier
+        The fitted clone of the forest
+    '''
+    forest = clone(forest)
+    forest._validate_params()
+    if forest.class_weight is not None or forest.oob_score:
+        raise ValueError('class_weight and oob_score are not supported')
+    # these limits count the rows, not their weights, so a row standing in
+    # for several copies would be counted once
+    for param, default in [('min_samples_leaf', 1), ('min_samples_split', 2),
+                           ('max_leaf_nodes', None)]:
+        if getattr(forest, param) != default:
+            raise ValueError(f'{param} must keep its default value ({default}), '
+                             f'got {getattr(forest, param)}')
+
+    # the validation and the bookkeeping of RandomForestClassifier.fit
+    X = forest._validate_data(X, dtype=np.float32, reset=True)
+    forest.classes_, y_encoded = np.unique(np.asarray(y), return_inverse=True)
+    forest.n_classes_ = len(forest.classes_)
+    forest.n_outputs_ = 1
+    y_encoded = y_encoded.astype(np.float64).reshape(-1, 1)
+
+    forest._validate_estimator()
+    random_state = check_random_state(forest.random_state)
+    trees = [forest._make_estimator(append=False, random_state=random_state)
+             for _ in range(forest.n_estimators)]
+
+    n_resampled = len(sample_indices)
+    n_samples_bootstrap = _get_n_samples_bootstrap(n_resampled,
+                                                   forest.max_samples)
+
+    def fit_tree(tree):
+        if forest.bootstrap:
+            tree_indices = sample_indices[_generate_sample_indices(
+                tree.random_state, n_resampled, n_samples_bootstrap
+            )]
+        else:
+            tree_indices = sample_indices
+        sample_weight = np.bincount(tree_indices, minlength=X.shape[0])
+        return tree.fit(X, y_encoded, sample_weight=sample_weight.astype(np.float64),
+                        check_input=False)
+
+    # the trees release the GIL, so they are fitted in threads (as in sklearn)
+    forest.estimators_ = Parallel(n_jobs=forest.n_jobs, prefer='threads')(
+        delayed(fit_tree)(tree) for tree in trees
+    )
+
+    return forest
+
+
+def _run_experiment(estimator, sampler, X_train, y_train, X_test, y_test,
+                    evaluate_fn, cache_dir, data_hash, n_threads):
+    '''
+    Resamples the training data (or loads it from the cache), fits the
+    estimator and evaluates it on the test set.
+    '''
+    if sampler is not None:
+        X_train, y_train = resample_cached(sampler, X_train, y_train,
+                                           cache_dir, data_hash)
+    estimator = clone(estimator)
+    if 'n_jobs' in estimator.get_params():
+        estimator.set_params(n_jobs=n_threads)
+    estimator.fit(X_train, y_train)
+    return estimator, evaluate_fn(estimator, X_test, y_test)
+
+
+def run_resampling_experiments(experiments, X_train, y_train, X_test, y_test,
+                               evaluate_fn, cache_dir='resampling_cache',
+                               n_jobs=-1, return_estimators=False):
+    '''
+    Trains and evaluates the estimators on the (resampled) training data,
+    running the experiments in parallel worker processes. The resampled
+    datasets are cached on disk, so rerunning the experiments (or adding
+    new ones) only resamples the data for the new samplers.
+
+    Parameters
+    ----------
+    experiments : dict
+        The experiments, mapping their names to (estimator, sampler) tuples.
+        With a None sampler, the estimator is trained on the original data.
+    X_train : pd.DataFrame
+        The training features
+    y_train : pd.Series
+        The training target
+    X_test : pd.DataFrame
+        The test features
+    y_test : pd.Series
+        The test target
+    evaluate_fn : callable
+        Function returning a dict of the performance metrics, called as
+        `evaluate_fn(fitted_estimator, X_test, y_test)`
+    cache_dir : str
+        Directory with the cached datasets
+    n_jobs : int
+        Number of worker processes, -1 means using all the cores. The cores
+        are split evenly between the estimators of the workers.
+    return_estimators : bool
+        Whether to return the fitted estimators as well
+
+    Returns
+    -------
+    performance_results : pd.DataFrame
+        The performance metrics of the experiments
+    fitted_estimators : dict
+        The fitted estimators of the experiments (only if
+        `return_estimators` is True)
+    '''
+    n_workers = min(effective_n_jobs(n_jobs), len(experiments))
+    n_threads = max(1, os.cpu_count() // n_workers)
+    data_hash = joblib.hash((X_train, y_train))
+
+    results = Parallel(n_jobs=n_workers)(
+        delayed(_run_experiment)(estimator, sampler, X_train, y_train,
+                                 X_test, y_test, evaluate_fn, cache_dir,
+                                 data_hash, n_threads)
+        for estimator, sampler in experiments.values()
+    )
+
+    performance_results = pd.DataFrame([result[1] for result in results],
+                                       index=list(experiments))
+    if return_estimators:
+        fitted_estimators = {name: result[0] for name, result
+                             in zip(experiments, results)}
+        return performance_results, fitted_estimators
+    return performance_results
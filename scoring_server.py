@@ -0,0 +1,498 @@
+'''
+Micro-batching HTTP server for scoring the fitted credit card default pipelines.
+
+Concurrent requests are queued and coalesced into micro-batches, which are
+scored with a single vectorized `predict_proba` call. The server only uses
+the standard library's asyncio, so it can be run and load-tested locally:
+
+    python scoring_server.py serve light_gbm_pipeline.joblib --port 8000
+    python scoring_server.py load-test --port 8000 --n-requests 10000
+
+Endpoints:
+    POST /predict - a JSON record (or a list of records) keyed by the
+                    feature names, returns the class probabilities
+    GET /metrics  - latency and throughput metrics of the server
+'''
+
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from data_utils import CSV_PATH, load_credit_card_default
+from scoring_utils import load_pipeline
+
+HTTP_REASONS = {200: 'OK',
+                400: 'Bad Request',
+                404: 'Not Found',
+                405: 'Method Not Allowed'}
+
+
+class ScoringMetrics:
+    '''
+    Latency and throughput metrics of the scoring server. The latency
+    percentiles are calculated over the most recent requests.
+
+    Parameters
+    ----------
+    window : int
+        Number of the most recent requests/batches kept for the percentiles
+    '''
+    def __init__(self, window=10000):
+        self.start_time = time.perf_counter()
+        self.n_requests = 0
+        self.n_failed = 0
+        self.n_records = 0
+        self.n_batches = 0
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.batch_durations = deque(maxlen=window)
+
+    def record_request(self, latency, n_records, failed=False):
+        self.n_requests += 1
+        self.n_records += n_records
+        self.n_failed += failed
+        self.latencies.append(latency)
+
+    def record_batch(self, batch_size, duration):
+        self.n_batches += 1
+        self.batch_sizes.append(batch_size)
+        self.batch_durations.append(duration)
+
+    def to_dict(self):
+        '''
+        Summarizes the metrics, the times are in milliseconds. The
+        throughput is averaged over the uptime of the server.
+        '''
+        uptime = time.perf_counter() - self.start_time
+        summary = {'uptime_s': uptime,
+                   'n_requests': self.n_requests,
+                   'n_failed': self.n_failed,
+                   'n_records': self.n_records,
+                   'n_batches': self.n_batches,
+                   'throughput_records_per_s': self.n_records / uptime}
+
+        if self.latencies:
+            latencies = 1000 * np.array(self.latencies)
+            summary['latency_ms'] = {
+                'mean': latencies.mean(),
+                'p50': np.percentile(latencies, 50),
+                'p95': np.percentile(latencies, 95),
+                'p99': np.percentile(latencies, 99),
+                'max': latencies.max()
+            }
+        if self.batch_sizes:
+            summary['mean_batch_size'] = np.mean(self.batch_sizes)
+            summary['mean_batch_duration_ms'] = 1000 * np.mean(self.batch_durations)
+
+        return summary
+
+
+class MicroBatcher:
+    '''
+    Coalesces concurrent scoring requests into micro-batches. A batch is
+    closed when it reaches `max_batch_size` records or when `batch_window`
+    seconds passed since its first request. The batches are scored in a
+    worker thread, so the event loop keeps accepting requests meanwhile.
+
+    Parameters
+    ----------
+    model : sklearn.pipeline.Pipeline
+        Fitted pipeline with the `predict_proba` method
+    batch_window : float
+        Maximum time (in seconds) the first request of a batch waits for
+        the others
+    max_batch_size : int
+        Maximum number of records in a batch
+    metrics : ScoringMetrics
+        Metrics updated with the size and duration of the batches
+    '''
+    def __init__(self, model, batch_window=0.005, max_batch_size=256,
+                 metrics=None):
+        self.model = model
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.metrics = metrics if metrics is not None else ScoringMetrics()
+        self.feature_names = list(model.feature_names_in_)
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        # the requests still waiting in the queue are cancelled as well
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+
+    async def predict_proba(self, records):
+        '''
+        Queues the records for scoring and waits for the result.
+
+        Parameters
+        ----------
+        records : list
+            List of dictionaries keyed by the feature names
+
+        Returns
+        -------
+        proba : np.ndarray
+            Array with the class probabilities of the records
+        '''
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((records, future))
+        return await future
+
+    def _predict_proba(self, records):
+        # missing keys and None values are scored as missing values
+        X = pd.DataFrame.from_records(records, columns=self.feature_names)
+        X = X.fillna(value=np.nan)
+        return self.model.predict_proba(X)
+
+    def _score_batch(self, batch):
+        '''
+        Scores the batch with a single call to `predict_proba`. If it fails,
+        the requests are scored one by one, so only the invalid ones fail.
+        '''
+        records = [record for request_records, _ in batch
+                   for record in request_records]
+        try:
+            proba = self._predict_proba(records)
+        except Exception:
+            results = []
+            for request_records, _ in batch:
+                try:
+                    results.append(self._predict_proba(request_records))
+                except Exception as e:
+                    results.append(e)
+            return results
+
+        bounds = np.cumsum([len(request_records) for request_records, _ in batch])
+        return np.split(proba, bounds[:-1])
+
+    @staticmethod
+    def _fail_batch(batch, exception):
+        '''
+        Fails the requests of the batch which are still waiting.
+        '''
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(exception)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            request = await self._queue.get()
+            batch = [request]
+
+            # any error fails the requests of the batch, but not the loop,
+            # otherwise all the following requests would wait forever
+            try:
+                await self._collect_and_score(loop, batch)
+            except asyncio.CancelledError:
+                for _, future in batch:
+                    future.cancel()
+                raise
+            except Exception as e:
+                self._fail_batch(batch, e)
+
+    async def _collect_and_score(self, loop, batch):
+        '''
+        Adds the requests arriving within the batch window to the batch,
+        scores it and sets the results of the requests.
+        '''
+        n_records = len(batch[0][0])
+        deadline = loop.time() + self.batch_window
+
+        while n_records < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(request)
+            n_records += len(request[0])
+
+        start = time.perf_counter()
+        results = await loop.run_in_executor(None, self._score_batch, batch)
+        self.metrics.record_batch(n_records, time.perf_counter() - start)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+async def _read_message(reader):
+    '''
+    Reads an HTTP message and returns its start line, headers and body.
+    Returns None if the connection was closed.
+    '''
+    start_line = await reader.readline()
+    if not start_line:
+        return None
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in [b'\r\n', b'\n', b'']:
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    content_length = int(headers.get('content-length', 0))
+    body = await reader.readexactly(content_length) if content_length else b''
+
+    return start_line.decode('latin-1').strip(), headers, body
+
+
+class ScoringServer:
+    '''
+    HTTP/1.1 front end (with keep-alive) of the micro-batching scorer.
+
+    Parameters
+    ----------
+    model : sklearn.pipeline.Pipeline
+        Fitted pipeline with the `predict_proba` method
+    host : str
+        Host to bind
+    port : int
+        Port to bind
+    batch_window : float
+        Maximum time (in seconds) the first request of a batch waits for
+        the others
+    max_batch_size : int
+        Maximum number of records in a batch
+    '''
+    def __init__(self, model, host='127.0.0.1', port=8000,
+                 batch_window=0.005, max_batch_size=256):
+        self.host = host
+        self.port = port
+        self.metrics = ScoringMetrics()
+        self.batcher = MicroBatcher(model, batch_window=batch_window,
+                                    max_batch_size=max_batch_size,
+                                    metrics=self.metrics)
+        self._server = None
+
+    async def start(self):
+        self.batcher.start()
+        self._server = await asyncio.start_server(self._handle_connection,
+                                                  self.host, self.port)
+        # the actual port, in case port 0 was requested
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        await self.batcher.stop()
+
+    async def serve_forever(self):
+        await self.start()
+        print(f'Serving on http://{self.host}:{self.port}')
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.batcher.stop()
+
+    async def _handle_request(self, method, path, body):
+        '''
+        Dispatches the request and returns the status code and the payload.
+        '''
+        if path == '/metrics':
+            if method != 'GET':
+                return 405, {'error': 'Use GET'}
+            return 200, self.metrics.to_dict()
+
+        if path != '/predict':
+            return 404, {'error': f'Unknown path: {path}'}
+        if method != 'POST':
+            return 405, {'error': 'Use POST'}
+
+        start = time.perf_counter()
+        n_records = 0
+        try:
+            records = json.loads(body)
+            if isinstance(records, dict):
+                records = [records]
+            if (not isinstance(records, list) or not records
+                    or not all(isinstance(record, dict) for record in records)):
+                raise ValueError('Expected a record or a non-empty list of records')
+            n_records = len(records)
+            proba = await self.batcher.predict_proba(records)
+        except Exception as e:
+            self.metrics.record_request(time.perf_counter() - start,
+                                        n_records, failed=True)
+            return 400, {'error': str(e)}
+
+        self.metrics.record_request(time.perf_counter() - start, n_records)
+        return 200, {'probabilities': proba.tolist()}
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                message = await _read_message(reader)
+                if message is None:
+                    break
+                start_line, headers, body = message
+                method, path, version = start_line.split(' ', 2)
+
+                status, payload = await self._handle_request(method, path, body)
+
+                keep_alive = (version == 'HTTP/1.1'
+                              and headers.get('connection', '').lower() != 'close')
+                content = json.dumps(payload).encode()
+                head = (f'HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n'
+                        f'Content-Type: application/json\r\n'
+                        f'Content-Length: {len(content)}\r\n'
+                        f'Connection: {"keep-alive" if keep_alive else "close"}\r\n'
+                        f'\r\n')
+                writer.write(head.encode('latin-1') + content)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def run_load_test(records, host='127.0.0.1', port=8000,
+                        n_requests=10000, concurrency=64):
+    '''
+    Sends single-record scoring requests over `concurrency` keep-alive
+    connections and measures the client-side latency.
+
+    Parameters
+    ----------
+    records : list
+        List of records to cycle through
+    host : str
+        Host of the server
+    port : int
+        Port of the server
+    n_requests : int
+        Total number of requests
+    concurrency : int
+        Number of concurrent connections
+
+    Returns
+    -------
+    summary : dict
+        Client-side latency (in milliseconds) and throughput, together
+        with the metrics reported by the server
+    '''
+    bodies = [json.dumps(record).encode() for record in records]
+    latencies = []
+    n_failed = 0
+
+    async def send(reader, writer, method, path, body=b''):
+        head = (f'{method} {path} HTTP/1.1\r\n'
+                f'Host: {host}\r\n'
+                f'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'\r\n')
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+        status_line, _, content = await _read_message(reader)
+        return int(status_line.split(' ', 2)[1]), content
+
+    async def worker(worker_ind):
+        nonlocal n_failed
+        reader, writer = await asyncio.open_connection(host, port)
+        for request_ind in range(worker_ind, n_requests, concurrency):
+            start = time.perf_counter()
+            status, _ = await send(reader, writer, 'POST', '/predict',
+                                   bodies[request_ind % len(bodies)])
+            latencies.append(time.perf_counter() - start)
+            n_failed += status != 200
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(worker_ind) for worker_ind in range(concurrency)])
+    duration = time.perf_counter() - start
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, server_metrics = await send(reader, writer, 'GET', '/metrics')
+    writer.close()
+
+    latencies = 1000 * np.array(latencies)
+    return {'n_requests': n_requests,
+            'n_failed': n_failed,
+            'throughput_requests_per_s': n_requests / duration,
+            'latency_ms': {'mean': latencies.mean(),
+                           'p50': np.percentile(latencies, 50),
+                           'p95': np.percentile(latencies, 95),
+                           'p99': np.percentile(latencies, 99),
+                           'max': latencies.max()},
+            'server': json.loads(server_metrics)}
+
+
+def get_load_test_records(csv_path=CSV_PATH, target='default_payment_next_month'):
+    '''
+    Prepares JSON-serializable records for the load test from the dataset.
+    '''
+    X = load_credit_card_default(csv_path).drop(columns=target)
+    X = X.astype(object).where(X.notna(), None)
+    return X.to_dict(orient='records')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='Run the scoring server')
+    serve_parser.add_argument('model_path',
+                              help='Path to the fitted pipeline saved with save_pipeline')
+    serve_parser.add_argument('--batch-window-ms', type=float, default=5,
+                              help='Maximum time the first request of a batch '
+                                   'waits for the others')
+    serve_parser.add_argument('--max-batch-size', type=int, default=256)
+
+    load_test_parser = subparsers.add_parser('load-test',
+                                             help='Load-test a running server')
+    load_test_parser.add_argument('--csv-path', default=CSV_PATH,
+                                  help='Dataset used for generating the requests')
+    load_test_parser.add_argument('--n-requests', type=int, default=10000)
+    load_test_parser.add_argument('--concurrency', type=int, default=64)
+
+    for subparser in [serve_parser, load_test_parser]:
+        subparser.add_argument('--host', default='127.0.0.1')
+        subparser.add_argument('--port', type=int, default=8000)
+
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = ScoringServer(load_pipeline(args.model_path),
+                               host=args.host, port=args.port,
+                               batch_window=args.batch_window_ms / 1000,
+                               max_batch_size=args.max_batch_size)
+        asyncio.run(server.serve_forever())
+    else:
+        records = get_load_test_records(args.csv_path)
+        summary = asyncio.run(run_load_test(records, host=args.host,
+                                            port=args.port,
+                                            n_requests=args.n_requests,
+                                            concurrency=args.concurrency))
+        print(json.dumps(summary, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,508 @@
+'''
+Helpers for persisting and scoring the fitted credit card default pipelines.
+'''
+
+import os
+import warnings
+from collections.abc import Mapping
+
+import joblib
+import numpy as np
+import scipy.sparse as sp
+import sklearn
+from joblib import Parallel, delayed, effective_n_jobs
+from numba import njit
+from scipy.special import expit
+from sklearn.compose import ColumnTransformer
+from sklearn.dummy import DummyClassifier
+from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, OrdinalEncoder
+from sklearn.tree import DecisionTreeClassifier
+
+
+def _is_missing(value):
+    '''
+    Checks if a single value is missing (None or NaN).
+    '''
+    return value is None or value != value
+
+
+def _get_column_steps(transformer):
+    '''
+    Splits the transformer applied to a group of columns of the
+    ColumnTransformer into the imputer and the encoder. Both can be None.
+    '''
+    if isinstance(transformer, str):
+        if transformer == 'passthrough':
+            return None, None
+        raise ValueError(f'Unsupported transformer: {transformer}')
+
+    if isinstance(transformer, Pipeline):
+        steps = [step for _, step in transformer.steps
+                 if step not in [None, 'passthrough']]
+    else:
+        steps = [transformer]
+
+    imputer, encoder = None, None
+    for step in steps:
+        if (isinstance(step, SimpleImputer) and imputer is None
+                and encoder is None and not step.add_indicator):
+            imputer = step
+        elif (isinstance(step, (OneHotEncoder, OrdinalEncoder))
+                and encoder is None):
+            encoder = step
+        else:
+            raise ValueError(f'Unsupported step: {step}')
+
+    return imputer, encoder
+
+
+@njit(nogil=True, cache=True)
+def _predict_forest(X, roots, feature, threshold, children_left,
+                    children_right, value, init_value):
+    '''
+    Sums the leaf values of all the trees for each row of the (float32)
+    block, in the order of the trees.
+    '''
+    total = np.full((X.shape[0], value.shape[1]), init_value)
+    # the rows are passed through one tree after another, which keeps
+    # the nodes of the current tree in the cache
+    for root in roots:
+        for row_ind in range(X.shape[0]):
+            node = root
+            while True:
+                left = children_left[node]
+                if left == -1:
+                    break
+                if X[row_ind, feature[node]] <= threshold[node]:
+                    node = left
+                else:
+                    node = children_right[node]
+            for col_ind in range(value.shape[1]):
+                total[row_ind, col_ind] += value[node, col_ind]
+    return total
+
+
+class CompiledForest:
+    '''
+    Inference engine for fitted RandomForestClassifier and (binary)
+    GradientBoostingClassifier models.
+
+    The nodes of all the trees are flattened into a few contiguous arrays,
+    which are traversed by a function compiled with numba. The blocks of
+    rows are processed in parallel threads, as the compiled function
+    releases the GIL. The arrays are plain NumPy arrays, so a saved
+    CompiledForest is memory-mapped by `load_pipeline` and shared by the
+    scoring processes, unlike sklearn's trees, which copy their nodes when
+    they are loaded.
+
+    The leaf values are accumulated over the trees in the same order and
+    with the same operations as in scikit-learn, so the probabilities are
+    bit-identical to the ones of `predict_proba` (of a forest predicting
+    with a single job).
+
+    Parameters
+    ----------
+    estimator : RandomForestClassifier or GradientBoostingClassifier
+        The fitted model
+    n_jobs : int
+        Number of threads processing the blocks of rows, -1 means using all
+        the cores
+    block_size : int
+        Number of rows in a block
+    '''
+
+    def __init__(self, estimator, n_jobs=-1, block_size=16384):
+        self.n_jobs = n_jobs
+        self.block_size = block_size
+        self.classes_ = estimator.classes_
+        self.n_features_in_ = estimator.n_features_in_
+
+        if isinstance(estimator, RandomForestClassifier):
+            if estimator.n_outputs_ != 1:
+                raise ValueError('Only single-output forests are supported')
+            trees = [tree.tree_ for tree in estimator.estimators_]
+            leaf_values = []
+            for tree in trees:
+                # normalized exactly as in DecisionTreeClassifier.predict_proba
+                proba = tree.value[:, 0, :estimator.n_classes_]
+                normalizer = proba.sum(axis=1)[:, np.newaxis]
+                normalizer[normalizer == 0.0] = 1.0
+                leaf_values.append(proba / normalizer)
+            self.boosting = False
+            self.init_value = 0.0
+        elif isinstance(estimator, GradientBoostingClassifier):
+            if estimator.n_classes_ != 2 or estimator.loss not in ['log_loss', 'deviance']:
+                raise ValueError('Only binary GradientBoostingClassifier '
+                                 'with the log-loss is supported')
+            if not (isinstance(estimator.init_, DummyClassifier)
+                    or estimator.init_ == 'zero'):
+                raise ValueError('Only the default init estimator is supported')
+            trees = [tree.tree_ for tree in estimator.estimators_[:, 0]]
+            # the scaled values are added as in sklearn's predict_stages
+            leaf_values = [estimator.learning_rate * tree.value[:, 0, :1]
+                           for tree in trees]
+            self.boosting = True
+            # the prior log-odds do not depend on the features
+            zeros = np.zeros((1, self.n_features_in_), dtype=np.float32)
+            self.init_value = estimator._raw_predict_init(zeros)[0, 0]
+        else:
+            raise ValueError(f'Unsupported estimator: {estimator}')
+
+        n_nodes = [tree.node_count for tree in trees]
+        self.roots = np.concatenate([[0], np.cumsum(n_nodes)[:-1]]).astype(np.intp)
+        offsets = np.repeat(self.roots, n_nodes)
+
+        # the leaves keep -1 as the children, the other children are
+        # shifted to the positions of the flattened nodes
+        children_left = np.concatenate([tree.children_left for tree in trees])
+        children_right = np.concatenate([tree.children_right for tree in trees])
+        is_leaf = children_left == -1
+        self.children_left = np.where(is_leaf, -1, children_left + offsets)
+        self.children_right = np.where(is_leaf, -1, children_right + offsets)
+        self.feature = np.concatenate([tree.feature for tree in trees]).astype(np.intp)
+        self.threshold = np.concatenate([tree.threshold for tree in trees])
+        self.value = np.concatenate(leaf_values)
+
+    def _predict_block(self, X):
+        if sp.issparse(X):
+            X = X.toarray()
+        # sklearn's trees compare the features in float32
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        # the trees are accumulated one by one (starting from the prior
+        # log-odds for boosting) to keep the order of the sums
+        total = _predict_forest(X, self.roots, self.feature, self.threshold,
+                                self.children_left, self.children_right,
+                                self.value, self.init_value)
+
+        if self.boosting:
+            proba = np.ones((X.shape[0], 2), dtype=np.float64)
+            proba[:, 1] = expit(total[:, 0])
+            proba[:, 0] -= proba[:, 1]
+            return proba
+
+        return total / len(self.roots)
+
+    def predict_proba(self, X):
+        '''
+        Predicts the class probabilities.
+
+        Parameters
+        ----------
+        X : array-like or sparse matrix
+            The transformed features
+
+        Returns
+        -------
+        proba : np.ndarray
+            Array with the probability of each class
+        '''
+        n_rows = X.shape[0]
+        if n_rows == 0:
+            return np.empty((0, len(self.classes_)))
+        n_jobs = effective_n_jobs(self.n_jobs)
+        # every thread gets at least one block
+        block_size = min(self.block_size, -(-n_rows // n_jobs))
+        if n_jobs == 1 or block_size == n_rows:
+            return np.vstack([self._predict_block(X[start:start + block_size])
+                              for start in range(0, n_rows, block_size)])
+
+        blocks = Parallel(n_jobs=n_jobs, prefer='threads')(
+            delayed(self._predict_block)(X[start:start + block_size])
+            for start in range(0, n_rows, block_size)
+        )
+        return np.vstack(blocks)
+
+    def predict(self, X):
+        '''
+        Predicts the classes.
+        '''
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+def compile_pipeline(pipeline, n_jobs=-1, block_size=16384):
+    '''
+    Replaces the RandomForestClassifier or GradientBoostingClassifier at
+    the end of the fitted pipeline with the equivalent CompiledForest.
+    Saved with `save_pipeline`, the node arrays of the compiled forest are
+    memory-mapped and shared by the scoring processes.
+
+    Parameters
+    ----------
+    pipeline : sklearn.pipeline.Pipeline
+        The fitted pipeline
+    n_jobs : int
+        Number of threads used by the CompiledForest
+    block_size : int
+        Maximum number of rows in a block processed by a thread
+
+    Returns
+    -------
+    compiled_pipeline : sklearn.pipeline.Pipeline
+        Pipeline with the same fitted preprocessing steps and the
+        compiled classifier
+    '''
+    name, classifier = pipeline.steps[-1]
+    compiled_classifier = CompiledForest(classifier, n_jobs=n_jobs,
+                                         block_size=block_size)
+    return Pipeline(steps=pipeline.steps[:-1] + [(name, compiled_classifier)])
+
+
+class CompiledPipeline:
+    '''
+    Low-latency scoring of single records with a fitted pipeline consisting
+    of a ColumnTransformer (imputation and encoding of the features) and a
+    classifier.
+
+    The fitted imputation values and category tables are extracted once into
+    flat lists, so scoring a record is a single pass over its values,
+    without the DataFrame validation and column dispatch of the pipeline.
+    A DecisionTreeClassifier is compiled into flat node arrays as well,
+    a RandomForestClassifier into a CompiledForest, other classifiers are
+    called directly on the transformed row.
+
+    Parameters
+    ----------
+    pipeline : sklearn.pipeline.Pipeline
+        Fitted pipeline with the 'preprocessor' (ColumnTransformer) and
+        the classifier as the last step. The supported transformers are
+        pipelines of a SimpleImputer followed by an optional OneHotEncoder
+        or OrdinalEncoder.
+    '''
+    def __init__(self, pipeline):
+        preprocessor = pipeline.named_steps['preprocessor']
+        classifier = pipeline.steps[-1][1]
+
+        if not isinstance(preprocessor, ColumnTransformer):
+            raise ValueError('The preprocessor must be a ColumnTransformer')
+
+        self.feature_names_in_ = list(preprocessor.feature_names_in_)
+        self.classes_ = classifier.classes_
+        positions = {name: ind for ind, name
+                     in enumerate(self.feature_names_in_)}
+
+        # tuples of (input position, fill value, output position,
+        # category table, value for unknown categories, one-hot encoding)
+        self._columns = []
+        n_output = 0
+
+        for _, transformer, columns in preprocessor.transformers_:
+            if isinstance(transformer, str) and transformer == 'drop':
+                continue
+
+            imputer, encoder = _get_column_steps(transformer)
+
+            for col_ind, column in enumerate(columns):
+                input_position = positions.get(column, column)
+                fill_value = (imputer.statistics_[col_ind]
+                              if imputer is not None else None)
+
+                if encoder is None:
+                    self._columns.append((input_position, fill_value,
+                                          n_output, None, None, False))
+                    n_output += 1
+                elif isinstance(encoder, OneHotEncoder):
+                    drop_ind = (encoder.drop_idx_[col_ind]
+                                if encoder.drop_idx_ is not None else None)
+                    table = {}
+                    for cat_ind, category in enumerate(encoder.categories_[col_ind]):
+                        # the dropped category is encoded with all zeros
+                        if cat_ind == drop_ind:
+                            table[category] = None
+                        else:
+                            table[category] = n_output
+                            n_output += 1
+                    unknown = KeyError if encoder.handle_unknown == 'error' else None
+                    self._columns.append((input_position, fill_value,
+                                          None, table, unknown, True))
+                else:
+                    table = {category: float(cat_ind) for cat_ind, category
+                             in enumerate(encoder.categories_[col_ind])}
+                    unknown = (encoder.unknown_value
+                               if encoder.handle_unknown == 'use_encoded_value'
+                               else KeyError)
+                    self._columns.append((input_position, fill_value,
+                                          n_output, table, unknown, False))
+                    n_output += 1
+
+        self.n_features_out_ = n_output
+
+        if isinstance(classifier, DecisionTreeClassifier) and classifier.n_outputs_ == 1:
+            tree = classifier.tree_
+            self._tree = (tree.children_left.tolist(),
+                          tree.children_right.tolist(),
+                          tree.feature.tolist(),
+                          tree.threshold.tolist())
+            # normalized exactly as in DecisionTreeClassifier.predict_proba
+            proba = tree.value[:, 0, :classifier.n_classes_]
+            normalizer = proba.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            self._leaf_proba = proba / normalizer
+            self._classifier = None
+        elif isinstance(classifier, RandomForestClassifier):
+            # sklearn's gradient boosting already predicts all the stages
+            # in a single compiled call, so only the forests are compiled
+            self._tree = None
+            self._classifier = CompiledForest(classifier, n_jobs=1)
+        else:
+            self._tree = None
+            self._classifier = classifier
+
+    def transform(self, record):
+        '''
+        Transforms a single record into the input of the classifier.
+
+        Parameters
+        ----------
+        record : dict or array-like
+            Dictionary keyed by the feature names or a sequence of values
+            in the order of the columns used for fitting the pipeline
+
+        Returns
+        -------
+        row : np.ndarray
+            1D array with the transformed features
+        '''
+        if isinstance(record, Mapping):
+            values = [record[name] for name in self.feature_names_in_]
+        else:
+            values = record
+
+        row = [0.0] * self.n_features_out_
+
+        for (input_position, fill_value, output_position,
+                table, unknown, one_hot) in self._columns:
+            value = values[input_position]
+            if _is_missing(value):
+                value = fill_value
+
+            if table is None:
+                row[output_position] = value
+                continue
+
+            try:
+                code = table[value]
+            except KeyError:
+                if unknown is KeyError:
+                    column = self.feature_names_in_[input_position]
+                    raise ValueError(f'Found unknown category {value} '
+                                     f'in column {column}')
+                code = unknown
+
+            if one_hot:
+                if code is not None:
+                    row[code] = 1.0
+            else:
+                row[output_position] = code
+
+        return np.array(row, dtype=np.float64)
+
+    def _predict_tree_proba(self, row):
+        '''
+        Traverses the compiled decision tree. As in scikit-learn, the
+        features are compared in float32.
+        '''
+        children_left, children_right, feature, threshold = self._tree
+        row = row.astype(np.float32).tolist()
+
+        node = 0
+        while children_left[node] != -1:
+            if row[feature[node]] <= threshold[node]:
+                node = children_left[node]
+            else:
+                node = children_right[node]
+
+        return self._leaf_proba[node].copy()
+
+    def predict_proba(self, record):
+        '''
+        Predicts the class probabilities of a single record.
+
+        Parameters
+        ----------
+        record : dict or array-like
+            Dictionary keyed by the feature names or a sequence of values
+            in the order of the columns used for fitting the pipeline
+
+        Returns
+        -------
+        proba : np.ndarray
+            1D array with the probability of each class, the same as the
+            corresponding row of `pipeline.predict_proba`
+        '''
+        row = self.transform(record)
+
+        if self._tree is not None:
+            return self._predict_tree_proba(row)
+
+        return self._classifier.predict_proba(row[np.newaxis, :])[0]
+
+    def predict(self, record):
+        '''
+        Predicts the class of a single record.
+        '''
+        return self.classes_[np.argmax(self.predict_proba(record))]
+
+
+def _get_versions():
+    '''
+    Versions of the libraries the saved pipelines depend on.
+    '''
+    return {'sklearn': sklearn.__version__, 'numpy': np.__version__}
+
+
+def save_pipeline(pipeline, path):
+    '''
+    Saves the fitted pipeline (or a CompiledPipeline) to a single file.
+
+    The file is an uncompressed joblib pickle, in which the NumPy arrays
+    are stored as raw, aligned buffers. `load_pipeline` memory-maps them
+    instead of reading them, so loading is fast and the scoring processes
+    loading the same file share a single copy of the arrays in the page
+    cache. The file is replaced atomically.
+
+    Only the arrays stored as NumPy attributes are shared. The trees of
+    sklearn's forests and gradient boosting keep their nodes in internal
+    structures, which are copied into every process when loaded. To share
+    a tree ensemble between the scoring processes, compile it first with
+    `compile_pipeline`, which stores the nodes in NumPy arrays.
+
+    Parameters
+    ----------
+    pipeline : object
+        The fitted pipeline
+    path : str
+        Path to the artifact
+    '''
+    artifact = {'pipeline': pipeline, 'versions': _get_versions()}
+    tmp_path = path + '.tmp'
+    joblib.dump(artifact, tmp_path, compress=0)
+    os.replace(tmp_path, path)
+
+
+def load_pipeline(path, mmap_mode='r'):
+    '''
+    Loads the pipeline saved with `save_pipeline`, warning if it was saved
+    with different library versions.
+
+    Parameters
+    ----------
+    path : str
+        Path to the artifact
+    mmap_mode : str
+        Memory-mapping mode of the NumPy arrays, None reads them into memory
+
+    Returns
+    -------
+    pipeline : object
+        The fitted pipeline
+    '''
+    artifact = joblib.load(path, mmap_mode=mmap_mode)
+
+    if artifact['versions'] != _get_versions():
+        warnings.warn(f'The pipeline was saved with {artifact["versions"]}, '
+                      f'but loaded with {_get_versions()}')
+
+    return artifact['pipeline']
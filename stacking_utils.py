@@ -0,0 +1,192 @@
+'''
+Stacking ensemble with cached out-of-fold predictions of the base models.
+'''
+
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import check_cv
+from sklearn.preprocessing import LabelEncoder
+from sklearn.utils import _safe_indexing
+from sklearn.utils.validation import check_memory
+
+
+def _fit_estimator(estimator, X, y):
+    return clone(estimator).fit(X, y)
+
+
+def _fit_and_predict(estimator, X, y, train, test, method):
+    '''
+    Fits the estimator on the training fold and predicts the validation fold.
+    '''
+    estimator = clone(estimator).fit(_safe_indexing(X, train),
+                                     _safe_indexing(y, train))
+    return getattr(estimator, method)(_safe_indexing(X, test))
+
+
+def fit_estimator(estimator, X, y, memory=None):
+    '''
+    Fits a clone of the estimator, caching the fitted model. The cache is
+    keyed by the class and hyperparameters of the estimator and by the data,
+    so fitting the same model to the same data again only loads it.
+
+    Parameters
+    ----------
+    estimator : object
+        The (not fitted) estimator
+    X : array-like
+        The features
+    y : array-like
+        The target
+    memory : str or joblib.Memory
+        The cache, either a joblib.Memory or the path to its directory.
+        With None, nothing is cached.
+
+    Returns
+    -------
+    estimator : object
+        The fitted clone of the estimator
+    '''
+    return check_memory(memory).cache(_fit_estimator)(estimator, X, y)
+
+
+def _get_stack_method(estimator):
+    for method in ['predict_proba', 'decision_function', 'predict']:
+        if hasattr(estimator, method):
+            return method
+
+
+def _to_features(predictions, method):
+    '''
+    Converts the predictions of a base model to the features of the
+    meta-learner. With two classes, only the probabilities of the positive
+    class are kept, as the other column is redundant.
+    '''
+    if predictions.ndim == 1:
+        return predictions.reshape(-1, 1)
+    if method == 'predict_proba' and predictions.shape[1] == 2:
+        return predictions[:, 1:]
+    return predictions
+
+
+class CachedStackingClassifier(ClassifierMixin, BaseEstimator):
+    '''
+    Stacking classifier equivalent to sklearn's `StackingClassifier`, which
+    caches the fitted base models and their out-of-fold predictions (per
+    fold) using joblib.Memory. The cache entries are keyed by the
+    hyperparameters of the base model, the data and the folds, so adding a
+    base model or changing the meta-learner only fits the new models, while
+    the predictions of the unchanged ones are loaded from the cache.
+
+    Parameters
+    ----------
+    estimators : list
+        The base models, as a list of (name, estimator) tuples
+    final_estimator : object
+        The meta-learner, by default LogisticRegression
+    cv : int or cross-validation generator
+        The cross-validation scheme used for the out-of-fold predictions.
+        It must be deterministic (e.g., with a fixed random_state),
+        otherwise the folds and the cache entries change with every fit.
+    stack_method : str
+        The method of the base models used for the predictions. With 'auto',
+        `predict_proba`, `decision_function` or `predict` (the first one
+        available).
+    n_jobs : int
+        Number of (base model, fold) pairs fitted in parallel
+    memory : str or joblib.Memory
+        The cache, either a joblib.Memory or the path to its directory.
+        With None, nothing is cached.
+    '''
+    def __init__(self, estimators, final_estimator=None, cv=5,
+                 stack_method='auto', n_jobs=None, memory=None):
+        self.estimators = estimators
+        self.final_estimator = final_estimator
+        self.cv = cv
+        self.stack_method = stack_method
+        self.n_jobs = n_jobs
+        self.memory = memory
+
+    @property
+    def named_estimators_(self):
+        return dict(zip([name for name, _ in self.estimators], self.estimators_))
+
+    def _get_stack_methods(self):
+        return [_get_stack_method(estimator) if self.stack_method == 'auto'
+                else self.stack_method
+                for _, estimator in self.estimators]
+
+    def get_oof_predictions(self, X, y):
+        '''
+        Computes (or loads from the cache) the out-of-fold predictions of
+        all the base models, which are the training features of the
+        meta-learner.
+
+        Returns
+        -------
+        oof_predictions : np.ndarray
+            The out-of-fold predictions stacked horizontally
+        '''
+        memory = check_memory(self.memory)
+        cv = check_cv(self.cv, y, classifier=True)
+        splits = list(cv.split(X, y))
+
+        methods = self._get_stack_methods()
+        fold_predictions = Parallel(n_jobs=self.n_jobs)(
+            delayed(memory.cache(_fit_and_predict))(estimator, X, y,
+                                                    train, test, method)
+            for (_, estimator), method in zip(self.estimators, methods)
+            for train, test in splits
+        )
+
+        oof_predictions = []
+        for model_ind, method in enumerate(methods):
+            model_predictions = fold_predictions[model_ind * len(splits):
+                                                 (model_ind + 1) * len(splits)]
+            predictions = np.empty((len(y),) + model_predictions[0].shape[1:])
+            for (_, test), fold_prediction in zip(splits, model_predictions):
+                predictions[test] = fold_prediction
+            oof_predictions.append(_to_features(predictions, method))
+
+        return np.hstack(oof_predictions)
+
+    def fit(self, X, y):
+        self._label_encoder = LabelEncoder().fit(y)
+        self.classes_ = self._label_encoder.classes_
+
+        self.stack_method_ = self._get_stack_methods()
+        # the base models are fitted exactly as by `fit_estimator`, so the
+        # models fitted separately before are loaded from the cache
+        memory = check_memory(self.memory)
+        self.estimators_ = Parallel(n_jobs=self.n_jobs)(
+            delayed(memory.cache(_fit_estimator))(estimator, X, y)
+            for _, estimator in self.estimators
+        )
+
+        final_estimator = (LogisticRegression() if self.final_estimator is None
+                           else self.final_estimator)
+        self.final_estimator_ = clone(final_estimator).fit(
+            self.get_oof_predictions(X, y), self._label_encoder.transform(y)
+        )
+
+        return self
+
+    def transform(self, X):
+        '''
+        Predicts with the base models fitted on the entire training set.
+        '''
+        return np.hstack([
+            _to_features(getattr(estimator, method)(X), method)
+            for estimator, method in zip(self.estimators_, self.stack_method_)
+        ])
+
+    def predict(self, X):
+        y_pred = self.final_estimator_.predict(self.transform(X))
+        return self._label_encoder.inverse_transform(y_pred)
+
+    def predict_proba(self, X):
+        return self.final_estimator_.predict_proba(self.transform(X))
+
+    def decision_function(self, X):
+        return self.final_estimator_.decision_function(self.transform(X))
@@ -0,0 +1,550 @@
+'''
+Helpers for running the hyperparameter searches.
+'''
+
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+from hyperopt import JOB_STATE_DONE, STATUS_OK, Trials, space_eval, tpe
+from hyperopt.base import Domain
+from hyperopt.utils import coarse_utcnow
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.base import clone
+from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.ensemble._forest import ForestClassifier
+from sklearn.metrics import check_scoring
+from sklearn.model_selection import ParameterSampler, check_cv
+from sklearn.utils import _safe_indexing
+
+
+def _to_json(obj):
+    '''
+    Serializes the object to JSON, converting the NumPy types.
+    '''
+    def default(value):
+        if isinstance(value, (np.generic, np.ndarray)):
+            return value.tolist()
+        raise TypeError(f'Object of type {type(value)} is not JSON serializable')
+
+    return json.dumps(obj, default=default)
+
+
+class TrialStore:
+    '''
+    Durable, append-only store of the trials of hyperparameter searches,
+    kept in a SQLite database. Every trial is appended by the worker which
+    evaluated it, as soon as it finishes, together with its hyperparameters,
+    loss, per-fold scores and fitting time. The searches can be resumed
+    after an interruption and several local processes can contribute to the
+    same study.
+
+    The store only keeps the path to the database, so it can be passed to
+    the worker processes.
+
+    Parameters
+    ----------
+    path : str
+        Path to the SQLite database, created if it does not exist
+    study_name : str
+        Name of the study (search) the trials belong to
+    '''
+    def __init__(self, path, study_name='default'):
+        self.path = path
+        self.study_name = study_name
+
+        with self._connect() as connection:
+            # the write-ahead log lets the readers work alongside a writer
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS trials (
+                    trial_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    study TEXT NOT NULL,
+                    status TEXT,
+                    loss REAL,
+                    fit_time REAL,
+                    duration REAL,
+                    fold_scores TEXT,
+                    params TEXT,
+                    vals TEXT,
+                    result TEXT,
+                    finished_at TEXT
+                )
+            ''')
+            connection.execute('CREATE INDEX IF NOT EXISTS trials_study '
+                               'ON trials (study)')
+        connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def add_trial(self, params, vals, result, duration):
+        '''
+        Appends a finished trial to the store.
+
+        Parameters
+        ----------
+        params : dict
+            The evaluated hyperparameters
+        vals : dict
+            Hyperopt's representation of the hyperparameters (indices for
+            the `hp.choice` options), used for resuming the search
+        result : dict
+            Result returned by the objective function. The optional
+            'fold_scores' and 'fit_time' entries are stored in separate
+            columns.
+        duration : float
+            Wall time of the trial in seconds
+        '''
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT INTO trials (study, status, loss, fit_time, duration, '
+                'fold_scores, params, vals, result, finished_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.study_name, result.get('status'), result.get('loss'),
+                 result.get('fit_time'), duration,
+                 _to_json(result.get('fold_scores')), _to_json(params),
+                 _to_json(vals), _to_json(result),
+                 time.strftime('%Y-%m-%d %H:%M:%S'))
+            )
+        connection.close()
+
+    def __len__(self):
+        with self._connect() as connection:
+            (n_trials, ) = connection.execute(
+                'SELECT COUNT(*) FROM trials WHERE study = ?',
+                (self.study_name, )
+            ).fetchone()
+        connection.close()
+        return n_trials
+
+    def load_trials(self):
+        '''
+        Rebuilds hyperopt's Trials object from the finished trials of the
+        study, for example to resume the search.
+
+        Returns
+        -------
+        trials : hyperopt.Trials
+            The trials of the study
+        '''
+        with self._connect() as connection:
+            rows = connection.execute(
+                'SELECT vals, result FROM trials WHERE study = ? '
+                'ORDER BY trial_id', (self.study_name, )
+            ).fetchall()
+        connection.close()
+
+        trials = Trials()
+        tids = trials.new_trial_ids(len(rows))
+        docs = []
+        for tid, (vals, result) in zip(tids, rows):
+            vals = json.loads(vals)
+            misc = {'tid': tid,
+                    'cmd': ('domain_attachment', 'FMinIter_Domain'),
+                    'workdir': None,
+                    'idxs': {name: [tid] * len(values)
+                             for name, values in vals.items()},
+                    'vals': vals}
+            docs.extend(trials.new_trial_docs([tid], [None],
+                                              [json.loads(result)], [misc]))
+
+        now = coarse_utcnow()
+        for doc in docs:
+            doc['state'] = JOB_STATE_DONE
+            doc['book_time'] = doc['refresh_time'] = now
+        trials.insert_trial_docs(docs)
+        trials.refresh()
+
+        return trials
+
+    def to_frame(self):
+        '''
+        Returns the trials of the study as a DataFrame, with a column per
+        hyperparameter and per fold score.
+
+        Returns
+        -------
+        trials_df : pd.DataFrame
+            The trials in the order of completion
+        '''
+        with self._connect() as connection:
+            trials_df = pd.read_sql_query(
+                'SELECT trial_id, status, loss, fit_time, duration, '
+                'fold_scores, params, finished_at FROM trials '
+                'WHERE study = ? ORDER BY trial_id',
+                connection, params=(self.study_name, )
+            )
+        connection.close()
+
+        params_df = pd.DataFrame(trials_df.pop('params').map(json.loads).tolist())
+        fold_scores = trials_df.pop('fold_scores').map(json.loads)
+        fold_scores_df = pd.DataFrame(
+            [scores or [] for scores in fold_scores]
+        ).add_prefix('fold_score_')
+
+        trials_df = pd.concat([trials_df, params_df, fold_scores_df], axis=1)
+        trials_df['iteration'] = np.arange(len(trials_df)) + 1
+
+        return trials_df
+
+
+def _evaluate(fn, params, fn_kwargs, vals=None, store=None):
+    '''
+    Evaluates the objective function in a worker process. As in hyperopt,
+    a returned number is treated as the loss. The finished trial is
+    appended to the store (if provided) right away.
+    '''
+    start = time.perf_counter()
+    result = fn(params, **fn_kwargs)
+    if not isinstance(result, dict):
+        result = {'loss': float(result), 'status': STATUS_OK}
+
+    if store is not None:
+        store.add_trial(params, vals, result, time.perf_counter() - start)
+
+    return result
+
+
+def get_trial_params(space, trial):
+    '''
+    Recovers the hyperparameters (with the actual values of the `hp.choice`
+    options, not their indices) proposed in a trial.
+    '''
+    vals = {name: values[0] for name, values in trial['misc']['vals'].items()
+            if len(values)}
+    return space_eval(space, vals)
+
+
+def _get_trials_prefix(trials, n_trials):
+    '''
+    Returns the first `n_trials` trials as a new Trials object.
+    '''
+    prefix = Trials()
+    prefix.insert_trial_docs(trials.trials[:n_trials])
+    prefix.refresh()
+    return prefix
+
+
+def parallel_fmin(fn, space, max_evals, trials=None, n_parallel=-1,
+                  algo=tpe.suggest, random_state=42, early_stop_fn=None,
+                  fn_kwargs=None, store=None, verbose=True):
+    '''
+    Parallel counterpart of hyperopt's `fmin`. In each round, the algorithm
+    proposes `n_parallel` new trials based on all the finished ones, which
+    are then evaluated concurrently in local worker processes.
+
+    With more trials proposed from the same history, the search is slightly
+    less sample-efficient than the sequential one, but the wall time of
+    `max_evals` trials is roughly divided by `n_parallel`.
+
+    Parameters
+    ----------
+    fn : callable
+        Objective function called as `fn(params, **fn_kwargs)`, returning
+        the loss or hyperopt's result dictionary
+    space : dict
+        The search space
+    max_evals : int
+        Total number of trials (including the ones already in `trials`)
+    trials : hyperopt.Trials
+        Trials to continue from. A new object is created when None.
+    n_parallel : int
+        Number of trials evaluated concurrently, -1 means using all the cores
+    algo : callable
+        Hyperopt's suggestion algorithm
+    random_state : int
+        Random state of the suggestion algorithm. The seed of each round
+        also depends on the number of finished trials (and, with a store,
+        on the process), so the resumed and the concurrent searches do not
+        repeat the same proposals.
+    early_stop_fn : callable
+        Hyperopt's early-stopping function (for example,
+        `hyperopt.early_stop.no_progress_loss`), called after every finished
+        trial
+    fn_kwargs : dict
+        Additional arguments of the objective function, such as the training
+        data. Large arrays are memory-mapped and shared by the workers.
+    store : TrialStore
+        Durable store of the trials. If provided, the search continues
+        from the trials already in the store (instead of `trials`), every
+        finished trial is appended to it, and before every round the
+        trials added by other processes sharing the study are loaded.
+    verbose : bool
+        Whether to print the progress after every round
+
+    Returns
+    -------
+    best : dict
+        The best hyperparameters, in the same format as returned by `fmin`
+        (indices for the `hp.choice` options)
+    '''
+    trials = trials if trials is not None else Trials()
+    fn_kwargs = fn_kwargs or {}
+    n_parallel = effective_n_jobs(n_parallel)
+    domain = Domain(fn, space)
+    seed_entropy = [random_state] if store is None else [random_state, os.getpid()]
+    early_stop_args = []
+
+    if store is not None:
+        trials = store.load_trials()
+    trials.refresh()
+    n_checked = len(trials)
+
+    with Parallel(n_jobs=n_parallel) as parallel:
+        while len(trials) < max_evals:
+            n_new = min(n_parallel, max_evals - len(trials))
+            new_ids = trials.new_trial_ids(n_new)
+            rstate = np.random.default_rng(seed_entropy + [len(trials)])
+            # after its random startup trials, TPE proposes a single trial
+            # per call, so every new trial gets its own call (and seed)
+            seeds = rstate.integers(2 ** 31 - 1, size=n_new)
+            new_trials = []
+            for new_id, seed in zip(new_ids, seeds):
+                new_trials.extend(algo([new_id], domain, trials, seed))
+            assert len(new_trials) == n_new
+
+            book_time = coarse_utcnow()
+            results = parallel(
+                delayed(_evaluate)(fn, get_trial_params(space, trial), fn_kwargs,
+                                   trial['misc']['vals'], store)
+                for trial in new_trials
+            )
+
+            if store is not None:
+                # includes the trials finished by the other processes
+                trials = store.load_trials()
+            else:
+                for trial, result in zip(new_trials, results):
+                    trial['state'] = JOB_STATE_DONE
+                    trial['result'] = result
+                    trial['book_time'] = book_time
+                    trial['refresh_time'] = coarse_utcnow()
+                trials.insert_trial_docs(new_trials)
+                trials.refresh()
+
+            if verbose:
+                print(f'{len(trials)}/{max_evals} trials, best loss: '
+                      f'{trials.best_trial["result"]["loss"]:.4f}')
+
+            if early_stop_fn is not None:
+                # the stopping function is called after every finished
+                # trial, as in `fmin`, not only after the last one of a round
+                stop = False
+                for n_trials in range(n_checked + 1, len(trials) + 1):
+                    stop, early_stop_args = early_stop_fn(
+                        _get_trials_prefix(trials, n_trials), *early_stop_args
+                    )
+                    if stop:
+                        break
+                n_checked = len(trials)
+                if stop:
+                    break
+
+    return trials.argmin
+
+
+class _PrefixModel:
+    '''
+    Stand-in for a classifier restricted to its first estimators, exposing
+    the probabilities predicted for the validation set to sklearn's scorers.
+    '''
+    _estimator_type = 'classifier'
+
+    def __init__(self, classes, proba):
+        self.classes_ = classes
+        self.proba = proba
+
+    def predict_proba(self, X):
+        return self.proba
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.proba, axis=1)]
+
+
+def get_prefix_probas(model, X, n_estimators_list):
+    '''
+    Predicts the class probabilities of the ensemble restricted to its first
+    n estimators (trees or boosting rounds), for each n in the list.
+
+    Parameters
+    ----------
+    model : object
+        Fitted forest, GradientBoostingClassifier, XGBClassifier or
+        LGBMClassifier
+    X : array-like
+        The (transformed) features
+    n_estimators_list : list
+        The numbers of the first estimators
+
+    Returns
+    -------
+    probas : dict
+        The probabilities for each number of estimators
+    '''
+    n_estimators_list = sorted(n_estimators_list)
+    probas = {}
+
+    if isinstance(model, ForestClassifier):
+        # the forest averages the probabilities of the trees, with the
+        # same random states of the first n trees as a forest of n trees
+        X = model._validate_X_predict(X)
+        total = np.zeros((X.shape[0], len(model.classes_)))
+        for tree_ind, tree in enumerate(model.estimators_[:n_estimators_list[-1]]):
+            total += tree.predict_proba(X, check_input=False)
+            if tree_ind + 1 in n_estimators_list:
+                probas[tree_ind + 1] = total / (tree_ind + 1)
+    elif isinstance(model, GradientBoostingClassifier):
+        for stage_ind, proba in enumerate(model.staged_predict_proba(X)):
+            if stage_ind + 1 in n_estimators_list:
+                probas[stage_ind + 1] = proba
+            if stage_ind + 1 == n_estimators_list[-1]:
+                break
+    elif type(model).__name__ == 'XGBClassifier':
+        for n_estimators in n_estimators_list:
+            probas[n_estimators] = model.predict_proba(
+                X, iteration_range=(0, n_estimators)
+            )
+    elif type(model).__name__ == 'LGBMClassifier':
+        for n_estimators in n_estimators_list:
+            probas[n_estimators] = model.predict_proba(
+                X, num_iteration=n_estimators
+            )
+    else:
+        raise ValueError(f'Unsupported model: {model}')
+
+    return probas
+
+
+def _fit_and_score_prefixes(pipeline, params, X, y, train, test, scorer,
+                            param_name, n_estimators_list):
+    '''
+    Fits the pipeline with the largest number of estimators on the training
+    fold and scores all the prefixes on the validation fold.
+    '''
+    pipeline = clone(pipeline).set_params(**params)
+    pipeline.set_params(**{param_name: max(n_estimators_list)})
+
+    start = time.perf_counter()
+    pipeline.fit(_safe_indexing(X, train), _safe_indexing(y, train))
+    fit_time = time.perf_counter() - start
+
+    X_test = pipeline[:-1].transform(_safe_indexing(X, test))
+    y_test = _safe_indexing(y, test)
+    model = pipeline[-1]
+    probas = get_prefix_probas(model, X_test, n_estimators_list)
+
+    scores = [scorer(_PrefixModel(model.classes_, probas[n_estimators]),
+                     X_test, y_test)
+              for n_estimators in n_estimators_list]
+
+    return scores, fit_time
+
+
+class EstimatorSweepSearchCV:
+    '''
+    Randomized search, in which every sampled configuration is evaluated
+    for all the considered numbers of estimators at the cost of a single
+    fit. The ensemble is fitted once with the largest number of estimators
+    and its prefixes are scored: the forests average the probabilities of
+    their first trees (which are the same trees a smaller forest would
+    have), the boosters predict using their first boosting rounds.
+
+    Parameters
+    ----------
+    estimator : sklearn.pipeline.Pipeline
+        The pipeline to be tuned. Its last step must be a forest,
+        GradientBoostingClassifier, XGBClassifier or LGBMClassifier.
+    param_distributions : dict
+        The grid of hyperparameters, including the number of estimators
+    n_iter : int
+        Number of sampled configurations (of the other hyperparameters)
+    scoring : str or callable
+        The scoring metric
+    cv : int or cross-validation generator
+        The cross-validation scheme
+    n_jobs : int
+        Number of (configuration, fold) pairs evaluated in parallel
+    random_state : int
+        Random state used for sampling the configurations
+    param_name : str
+        Name of the hyperparameter with the number of estimators
+    verbose : int
+        Verbosity of joblib's Parallel
+    '''
+    def __init__(self, estimator, param_distributions, n_iter=10,
+                 scoring=None, cv=5, n_jobs=None, random_state=None,
+                 param_name='classifier__n_estimators', verbose=0):
+        self.estimator = estimator
+        self.param_distributions = param_distributions
+        self.n_iter = n_iter
+        self.scoring = scoring
+        self.cv = cv
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.param_name = param_name
+        self.verbose = verbose
+
+    def fit(self, X, y):
+        param_distributions = self.param_distributions.copy()
+        n_estimators_list = sorted(int(n_estimators) for n_estimators
+                                   in param_distributions.pop(self.param_name))
+        candidates = list(ParameterSampler(param_distributions, self.n_iter,
+                                           random_state=self.random_state))
+        cv = check_cv(self.cv, y, classifier=True)
+        splits = list(cv.split(X, y))
+        scorer = check_scoring(self.estimator, scoring=self.scoring)
+
+        results = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(
+            delayed(_fit_and_score_prefixes)(self.estimator, params, X, y,
+                                             train, test, scorer,
+                                             self.param_name, n_estimators_list)
+            for params in candidates for train, test in splits
+        )
+
+        # scores of shape (configurations, folds, numbers of estimators)
+        scores = np.array([fold_scores for fold_scores, _ in results])
+        scores = scores.reshape(len(candidates), len(splits), -1)
+        fit_times = np.array([fit_time for _, fit_time in results])
+        fit_times = fit_times.reshape(len(candidates), len(splits))
+
+        all_params = [{**params, self.param_name: n_estimators}
+                      for params in candidates
+                      for n_estimators in n_estimators_list]
+        # the folds of all the prefixes of a configuration share the fit
+        split_scores = scores.transpose(0, 2, 1).reshape(len(all_params), -1)
+        mean_scores = split_scores.mean(axis=1)
+
+        self.cv_results_ = {'params': all_params}
+        for name in all_params[0]:
+            self.cv_results_[f'param_{name}'] = np.array(
+                [params[name] for params in all_params], dtype=object
+            )
+        for fold_ind in range(len(splits)):
+            self.cv_results_[f'split{fold_ind}_test_score'] = split_scores[:, fold_ind]
+        self.cv_results_['mean_test_score'] = mean_scores
+        self.cv_results_['std_test_score'] = split_scores.std(axis=1)
+        self.cv_results_['rank_test_score'] = (
+            pd.Series(mean_scores).rank(method='min', ascending=False)
+              .astype(int).values
+        )
+        self.cv_results_['mean_fit_time'] = np.repeat(fit_times.mean(axis=1),
+                                                      len(n_estimators_list))
+
+        self.best_index_ = int(np.argmax(mean_scores))
+        self.best_params_ = all_params[self.best_index_]
+        self.best_score_ = mean_scores[self.best_index_]
+        self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+        self.best_estimator_.fit(X, y)
+        self.classes_ = self.best_estimator_.classes_
+
+        return self
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)